@@ -1,16 +1,22 @@
 """
 TG Cloud - Optimized for speed
-- 1.9GB chunks (Telegram max)
+- Configurable chunk size (TG_CHUNK_SIZE, up to the 1.9GB Telegram max)
 - Real progress with speed/ETA
 - Streaming downloads
 """
 import os
+import json
+import time
+import uuid
 import asyncio
+import mimetypes
 import threading
 from pathlib import Path
 from flask import Flask, request, jsonify, render_template_string, Response
 from werkzeug.utils import secure_filename
-from tg_storage import TelegramStorage
+from tg_storage import TelegramStorage, Progress, UploadPipe, Chunker
+import metrics
+from metrics import PHASE_SECONDS, TRANSFER_BYTES
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 2 * 1024 * 1024 * 1024
@@ -33,12 +39,108 @@ def get_loop():
 def run_async(coro):
     return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
 
+def iter_async(agen):
+    """Drive an async generator from a WSGI response; it only advances when the client reads"""
+    try:
+        while True:
+            try:
+                yield run_async(agen.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        run_async(agen.aclose())
+
+_storage = None
+_storage_lock = threading.Lock()
+PENDING_TTL_HOURS = float(os.environ.get('TG_PENDING_TTL_HOURS', 24))
+READY_TTL_HOURS = float(os.environ.get('TG_READY_TTL_HOURS', 1))
+
+def sweep_downloads(max_age_hours):
+    """Remove prepared files nobody has downloaded for max_age_hours, and leftovers of failed prepares"""
+    cutoff = time.time() - max_age_hours * 3600
+    removed = 0
+    for path in Path('/tmp/downloads').glob('ready_*'):
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+                removed += 1
+        except FileNotFoundError:
+            pass  # removed by another worker's sweep
+    return removed
+
+async def sweep_forever(storage):
+    """Hourly clean-up of abandoned uploads, stale prepared downloads and chunk messages still queued for deletion"""
+    while True:
+        try:
+            storage.prune_jobs(PENDING_TTL_HOURS)
+            swept = await storage.sweep_pending(PENDING_TTL_HOURS)
+            if swept:
+                print(f"Swept {swept} abandoned upload{'s' if swept > 1 else ''}")
+            removed = sweep_downloads(READY_TTL_HOURS)
+            if removed:
+                print(f"Removed {removed} prepared download{'s' if removed > 1 else ''}")
+            # Retries deletions an earlier drain couldn't finish
+            await storage.drain_deletes()
+        except Exception as e:
+            print(f"Sweep failed: {e}")
+        await asyncio.sleep(3600)
+
 def get_storage():
-    return TelegramStorage(
-        api_id=os.environ.get('TG_API_ID'),
-        api_hash=os.environ.get('TG_API_HASH'),
-        channel_id=os.environ.get('TG_CHANNEL_ID')
-    )
+    """One storage per worker; its Telegram connections stay open on the background loop"""
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            storage = TelegramStorage(
+                api_id=os.environ.get('TG_API_ID'),
+                api_hash=os.environ.get('TG_API_HASH'),
+                channel_id=os.environ.get('TG_CHANNEL_ID'),
+                pool_size=int(os.environ.get('TG_POOL_SIZE', 2))
+            )
+            run_async(storage.start())
+            asyncio.run_coroutine_threadsafe(sweep_forever(storage), get_loop())
+            # Started per worker, after gunicorn forks, so /metrics on any worker sees them all
+            metrics.share()
+            _storage = storage
+    return _storage
+
+def submit_job(kind, make_coro, total=0, key=None):
+    """Run a Telegram transfer in the background on the shared loop; its state lives in the jobs table.
+
+    make_coro gets the job's Progress to pass on as the transfer's progress_callback.
+    Jobs given a key are single-flight: while one is running, any worker submitting the same kind and key gets its id back.
+    """
+    storage = get_storage()
+    if key is None:
+        job_id = uuid.uuid4().hex
+        storage.create_job(job_id, kind, total)
+    else:
+        job_id = f"{kind}-{key}"
+        if not storage.claim_job(job_id, kind, total):
+            return job_id
+    progress = Progress(total, on_update=lambda p: storage.job_progress(job_id, p))
+    
+    async def run():
+        try:
+            result = await make_coro(progress)
+        except Exception as e:
+            print(f"Job {job_id} ({kind}) failed: {e}")
+            storage.finish_job(job_id, error=str(e) or type(e).__name__)
+        else:
+            storage.finish_job(job_id, result)
+    
+    asyncio.run_coroutine_threadsafe(run(), get_loop())
+    return job_id
+
+LIST_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+LISTING_CACHE_SIZE = 256
+FILE_TYPES = {
+    'video': ['mp4', 'm4v', 'mov', 'webm', 'mkv', 'avi'],
+    'audio': ['mp3', 'm4a', 'flac', 'wav', 'ogg'],
+    'image': ['jpg', 'jpeg', 'png', 'gif', 'webp'],
+}
+# Rendered listing pages keyed by query string; an entry is reused only while its library version is current
+listing_cache = {}
 
 HTML = """
 <!DOCTYPE html>
@@ -58,7 +160,13 @@ HTML = """
         .progress { height: 30px; background: #222; border-radius: 15px; overflow: hidden; margin: 10px 0; display: none; position: relative; }
         .progress-bar { height: 100%; background: linear-gradient(90deg, #0088cc, #00aaff); width: 0%; transition: width 0.2s; }
         .progress-text { position: absolute; top: 50%; left: 50%; transform: translate(-50%, -50%); font-size: 13px; font-weight: 600; text-shadow: 0 1px 2px rgba(0,0,0,0.5); }
-        .file-list { margin-top: 30px; }
+        .filters { display: flex; gap: 10px; margin-top: 30px; }
+        .filters input, .filters select { padding: 10px; border-radius: 6px; border: 1px solid #333; background: #1a1a1a; color: #fff; }
+        .filters input { flex: 1; }
+        .file-list { margin-top: 10px; }
+        .filters #deleteSelected { display: none; }
+        .pick { margin-right: 12px; width: 18px; height: 18px; }
+        .btn-more { display: none; width: 100%; background: #1a1a1a; color: #0088cc; margin-top: 10px; }
         .file { display: flex; justify-content: space-between; align-items: center; padding: 15px; background: #1a1a1a; border-radius: 8px; margin: 10px 0; }
         .file-info { flex: 1; }
         .file-name { font-weight: 600; color: #fff; }
@@ -92,7 +200,7 @@ HTML = """
     <div class="upload-zone" id="dropZone">
         <input type="file" id="fileInput" multiple>
         <p>📁 Drop files here or click to upload</p>
-        <p style="color:#666;font-size:14px">Files over 1.9GB are automatically split</p>
+        <p style="color:#666;font-size:14px">Files over {{ chunk_label }} are automatically split</p>
     </div>
     
     <div class="progress" id="progressContainer">
@@ -101,10 +209,25 @@ HTML = """
     </div>
     <div id="statusText"></div>
     <div class="status" id="status"></div>
+    <div class="filters">
+        <input type="search" id="search" placeholder="Search files...">
+        <select id="typeFilter">
+            <option value="">All types</option>
+            <option value="video">Videos</option>
+            <option value="audio">Audio</option>
+            <option value="image">Images</option>
+        </select>
+        <button class="btn btn-delete" id="deleteSelected">🗑️ Delete selected</button>
+    </div>
     <div class="file-list" id="fileList"></div>
+    <button class="btn btn-more" id="loadMore">Load more</button>
 
 <script>
-const CHUNK_SIZE = 1900 * 1024 * 1024;
+const CHUNK_SIZE = {{ chunk_size }};
+const PARALLEL_CHUNKS = {{ parallel_chunks }};
+// Content-defined chunking rules, so the page cuts a file exactly where the CLI would
+const CDC = {{ cdc|tojson }};
+const SCAN_BLOCK = 8 * 1024 * 1024;
 const $ = id => document.getElementById(id);
 
 $('dropZone').onclick = () => $('fileInput').click();
@@ -131,89 +254,162 @@ async function handleFiles(files) {
     loadFiles();
 }
 
+const hex = buffer => Array.from(new Uint8Array(buffer), b => b.toString(16).padStart(2, '0')).join('');
+
+// Same file → same id, so a re-dropped file resumes where the last attempt stopped
+async function resumeKey(file) {
+    // The chunking is part of the key: chunks cut another way can't be resumed
+    const key = new TextEncoder().encode(`${file.name}:${file.size}:${file.lastModified}:cdc${CHUNK_SIZE}`);
+    return hex(await crypto.subtle.digest('SHA-256', key));
+}
+
+const CRC_TABLE = Array.from({ length: 256 }, (_, n) => {
+    for (let k = 0; k < 8; k++) n = n & 1 ? 0xEDB88320 ^ (n >>> 1) : n >>> 1;
+    return n >>> 0;
+});
+
+function crc32(bytes, from, to) {
+    let c = 0xFFFFFFFF;
+    for (let i = from; i < to; i++) c = CRC_TABLE[(c ^ bytes[i]) & 0xFF] ^ (c >>> 8);
+    return (c ^ 0xFFFFFFFF) >>> 0;
+}
+
+// End offset of each chunk, cut by the same rules as tg_storage.Chunker so a file sharing
+// footage with one already stored shares its chunks too. Only bytes past each chunk's minimum size are read.
+async function cutPoints(file) {
+    const [m0, m1] = CDC.marker;
+    const ends = [];
+    let start = 0;
+    while (start < file.size) {
+        const hi = Math.min(start + CDC.max, file.size);
+        let cut = null, rejected = 0;
+        for (let from = start + CDC.min; cut === null && from <= hi; ) {
+            // Cuts in [from, to]; the window before `from` comes along for the CRC
+            const to = Math.min(hi, from + SCAN_BLOCK);
+            const base = from - CDC.window;
+            const bytes = new Uint8Array(await file.slice(base, to).arrayBuffer());
+            for (let i = bytes.indexOf(m0, from - 2 - base); i !== -1 && base + i + 2 <= to; i = bytes.indexOf(m0, i + 1)) {
+                if (bytes[i + 1] !== m1) continue;
+                if (rejected >= CDC.patience || crc32(bytes, i + 2 - CDC.window, i + 2) % CDC.modulus === 0) {
+                    cut = base + i + 2;
+                    break;
+                }
+                rejected++;
+            }
+            from = to + 1;
+        }
+        start = cut === null ? hi : cut;
+        ends.push(start);
+    }
+    return ends;
+}
+
+// SHA-256 over the SHA-256s of the chunk's CDC.piece-sized pieces, like tg_storage.Fingerprint
+async function fingerprint(blob) {
+    const digests = new Uint8Array(Math.ceil(blob.size / CDC.piece) * 32);
+    for (let pos = 0; pos < blob.size; pos += CDC.piece) {
+        const piece = await blob.slice(pos, pos + CDC.piece).arrayBuffer();
+        digests.set(new Uint8Array(await crypto.subtle.digest('SHA-256', piece)), pos / CDC.piece * 32);
+    }
+    return hex(await crypto.subtle.digest('SHA-256', digests));
+}
+
+// Follows a server-side transfer over Server-Sent Events; onProgress gets {bytes, total, rate, eta}
+function waitForJob(id, onProgress) {
+    return new Promise((resolve, reject) => {
+        const events = new EventSource(`/api/jobs/${id}/events`);
+        events.onmessage = e => {
+            const job = JSON.parse(e.data);
+            if (onProgress && job.total) onProgress(job);
+            if (job.status === 'done') { events.close(); resolve(job.result); }
+            else if (job.status === 'error' || job.error) { events.close(); reject(new Error(job.error)); }
+        };
+        events.onerror = () => { events.close(); reject(new Error('Lost connection to server')); };
+    });
+}
+
 async function uploadFile(file) {
-    const totalChunks = Math.ceil(file.size / CHUNK_SIZE);
-    const uploadId = crypto.randomUUID();
-    let startTime = Date.now();
-    
     $('progressContainer').style.display = 'block';
     $('progressBar').style.width = '0%';
     $('progressPercent').textContent = '0%';
+    $('statusText').textContent = '🔍 Finding chunk boundaries...';
+    let ends;
+    try {
+        ends = await cutPoints(file);
+    } catch (err) {
+        showStatus(`❌ Failed: ${err.message}`, 'error');
+        $('statusText').textContent = '';
+        $('progressContainer').style.display = 'none';
+        return;
+    }
+    const totalChunks = ends.length;
+    const uploadId = await resumeKey(file);
+    const chunkStart = i => i ? ends[i - 1] : 0;
+    const chunkBytes = i => ends[i] - chunkStart(i);
+    const sum = arr => arr.reduce((a, b) => a + b, 0);
+    
+    // Per-chunk bytes received by the server and bytes confirmed by Telegram, both real
+    const toServer = new Array(totalChunks).fill(0);
+    const toTelegram = new Array(totalChunks).fill(0);
+    const tgRates = {};
+    let serverSent = 0;
+    let startTime = Date.now();
+    let phase = '';
+    
+    const render = () => {
+        const pct = file.size ? (sum(toServer) + sum(toTelegram)) / (2 * file.size) * 100 : 100;
+        $('progressBar').style.width = pct.toFixed(1) + '%';
+        $('progressPercent').textContent = pct.toFixed(1) + '%';
+        
+        const serverRate = serverSent / ((Date.now() - startTime) / 1000);
+        const tgRate = sum(Object.values(tgRates));
+        const serverLeft = serverRate ? (file.size - sum(toServer)) / serverRate : 0;
+        const tgLeft = tgRate ? (file.size - sum(toTelegram)) / tgRate : 0;
+        const eta = Math.max(serverLeft, tgLeft);
+        $('statusText').textContent = `${phase} • ⬆️ Server ${formatSize(serverRate)}/s • 📤 Telegram ${formatSize(tgRate)}/s` + (eta ? ` • ~${formatTime(eta)} left` : '');
+    };
     
     try {
-        for (let i = 0; i < totalChunks; i++) {
-            const start = i * CHUNK_SIZE;
-            const end = Math.min(start + CHUNK_SIZE, file.size);
-            const chunk = file.slice(start, end);
+        const status = await (await fetch(`/api/upload/status/${uploadId}`)).json();
+        if (status.file_id) {
+            showStatus(`✅ ${file.name} is already uploaded`, 'success');
+            $('progressContainer').style.display = 'none';
+            return;
+        }
+        for (const i of status.confirmed) toServer[i] = toTelegram[i] = chunkBytes(i);
+        // Several chunks go up at once; the server pipes each one on to Telegram while it arrives
+        const pending = [];
+        for (let i = 0; i < totalChunks; i++) if (!toTelegram[i]) pending.push(i);
+        
+        const sendChunk = async i => {
+            const chunk = file.slice(chunkStart(i), ends[i]);
+            const fields = { upload_id: uploadId, chunk_index: i, total_chunks: totalChunks, filename: file.name, total_size: file.size };
             
-            // Phase 1: Upload to Railway
-            await new Promise((resolve, reject) => {
+            // Content already on Telegram (from this file or any other) is pointed at instead of sent again
+            const reuse = await fetch('/api/upload/reuse', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ ...fields, size: chunk.size, fingerprint: await fingerprint(chunk) })
+            });
+            if (!reuse.ok) throw new Error(await reuse.text());
+            if (!(await reuse.json()).reused) await sendBody(i, chunk, new URLSearchParams(fields));
+            toServer[i] = toTelegram[i] = chunk.size;
+            phase = `${toTelegram.filter((b, j) => b === chunkBytes(j)).length}/${totalChunks} chunks`;
+            render();
+        };
+        
+        const sendBody = async (i, chunk, params) => {
+            const queued = await new Promise((resolve, reject) => {
                 const xhr = new XMLHttpRequest();
-                const formData = new FormData();
-                formData.append('chunk', chunk);
-                formData.append('upload_id', uploadId);
-                formData.append('chunk_index', i);
-                formData.append('total_chunks', totalChunks);
-                formData.append('filename', file.name);
-                formData.append('total_size', file.size);
-                
-                let tgInterval = null;
-                let fakeProgress = 0;
-                
+                let lastLoaded = 0;
                 xhr.upload.onprogress = e => {
-                    if (e.lengthComputable) {
-                        $('statusText').className = '';
-                        const chunkProgress = e.loaded / e.total;
-                        // Each chunk gets equal share: chunk 0 = 0-50%, chunk 1 = 50-100% for 2 chunks
-                        // Within each chunk: first half is Railway, second half is TG
-                        const chunkShare = 100 / totalChunks; // e.g., 50% per chunk if 2 chunks
-                        const railwayPortion = chunkShare / 2; // e.g., 25% for Railway part
-                        const overallProgress = (i * chunkShare) + (chunkProgress * railwayPortion);
-                        const pct = overallProgress.toFixed(1);
-                        $('progressBar').style.width = pct + '%';
-                        $('progressPercent').textContent = pct + '%';
-                        
-                        const elapsed = (Date.now() - startTime) / 1000;
-                        const speed = (i * CHUNK_SIZE + e.loaded) / elapsed;
-                        const remaining = (file.size - (i * CHUNK_SIZE + e.loaded)) / speed * 2;
-                        $('statusText').textContent = `⬆️ Chunk ${i + 1}/${totalChunks} → Server: ${formatSize(speed)}/s • ~${formatTime(remaining)} left`;
-                    }
-                };
-                
-                // When browser→Railway upload completes, start fake progress animation
-                xhr.upload.onload = () => {
-                    const chunkShare = 100 / totalChunks;
-                    const baseProgress = (i * chunkShare) + (chunkShare / 2);
-                    const targetProgress = ((i + 1) * chunkShare) - 0.5;
-                    fakeProgress = baseProgress;
-                    const progressRange = targetProgress - baseProgress;
-                    
-                    // TG uploads at ~3 MB/s - calculate expected time for this chunk
-                    const chunkBytes = Math.min(CHUNK_SIZE, file.size - (i * CHUNK_SIZE));
-                    const tgSpeedBps = 3 * 1024 * 1024; // 3 MB/s
-                    const expectedSeconds = Math.max(5, chunkBytes / tgSpeedBps);
-                    const incrementPerTick = progressRange / expectedSeconds;
-                    
-                    $('statusText').className = 'telegram';
-                    
-                    let elapsed = 0;
-                    tgInterval = setInterval(() => {
-                        elapsed++;
-                        if (fakeProgress < targetProgress) {
-                            fakeProgress += incrementPerTick;
-                            $('progressBar').style.width = fakeProgress.toFixed(1) + '%';
-                            $('progressPercent').textContent = fakeProgress.toFixed(1) + '%';
-                        }
-                        const remaining = Math.max(0, Math.round(expectedSeconds - elapsed));
-                        const remMins = Math.floor(remaining / 60);
-                        const remSecs = remaining % 60;
-                        $('statusText').textContent = `📤 Sending to Telegram... ~${remMins}:${remSecs.toString().padStart(2, '0')} left`;
-                    }, 1000);
+                    toServer[i] = Math.min(chunk.size, e.loaded);
+                    serverSent += e.loaded - lastLoaded;
+                    lastLoaded = e.loaded;
+                    render();
                 };
-                
                 xhr.onload = () => {
-                    if (tgInterval) clearInterval(tgInterval);
-                    if (xhr.status === 200) {
+                    if (xhr.status === 200 || xhr.status === 202) {
                         resolve(JSON.parse(xhr.response));
                     } else {
                         let errMsg = 'Upload failed';
@@ -226,22 +422,31 @@ async function uploadFile(file) {
                         reject(new Error(errMsg));
                     }
                 };
-                xhr.onerror = () => {
-                    if (tgInterval) clearInterval(tgInterval);
-                    reject(new Error('Network error'));
-                };
-                xhr.open('POST', '/api/upload/chunk');
-                xhr.send(formData);
+                xhr.onerror = () => reject(new Error('Network error'));
+                // The chunk is the raw body so the server can forward it before it has all arrived
+                xhr.open('POST', `/api/upload/chunk?${params}`);
+                xhr.setRequestHeader('Content-Type', 'application/octet-stream');
+                xhr.send(chunk);
             });
+            toServer[i] = chunk.size;
             
-            // Update after TG upload complete
-            $('statusText').className = '';
-            const chunkShare = 100 / totalChunks;
-            const overallProgress = (i + 1) * chunkShare;
-            $('progressBar').style.width = overallProgress.toFixed(1) + '%';
-            $('progressPercent').textContent = overallProgress.toFixed(1) + '%';
-        }
+            if (queued.job) {
+                await waitForJob(queued.job, job => {
+                    toTelegram[i] = job.bytes;
+                    tgRates[i] = job.rate;
+                    render();
+                });
+                delete tgRates[i];
+            }
+        };
         
+        const worker = async () => {
+            while (pending.length) await sendChunk(pending.shift());
+        };
+        phase = '📤 Sending to Telegram';
+        $('statusText').className = 'telegram';
+        await Promise.all(Array.from({ length: Math.min(PARALLEL_CHUNKS, pending.length) }, worker));
+        $('statusText').className = '';
         $('statusText').textContent = 'Finalizing...';
         const res = await fetch('/api/upload/finalize', {
             method: 'POST',
@@ -269,66 +474,60 @@ function showStatus(msg, type) {
     setTimeout(() => $('status').style.display = 'none', 5000);
 }
 
-async function loadFiles() {
-    const files = await (await fetch('/api/files')).json();
-    $('fileCount').textContent = files.length;
-    $('totalSize').textContent = formatSize(files.reduce((s, f) => s + f.size, 0));
+const isVideo = name => /\.(mp4|m4v|mov|webm|mkv)$/i.test(name);
+
+let nextCursor = null;
+let listRequest = 0;
+
+async function loadFiles(more = false) {
+    const params = new URLSearchParams();
+    if ($('search').value.trim()) params.set('q', $('search').value.trim());
+    if ($('typeFilter').value) params.set('type', $('typeFilter').value);
+    if (more) params.set('cursor', nextCursor);
+    // Drop responses that a newer search has already superseded
+    const request = ++listRequest;
+    const page = await (await fetch('/api/files?' + params)).json();
+    if (request !== listRequest) return;
     
-    $('fileList').innerHTML = files.map(f => `
+    $('fileCount').textContent = page.count;
+    $('totalSize').textContent = formatSize(page.total_size);
+    nextCursor = page.next;
+    $('loadMore').style.display = nextCursor ? 'block' : 'none';
+    
+    if (!more) {
+        $('fileList').innerHTML = '';
+        updateSelection();
+    }
+    $('fileList').insertAdjacentHTML('beforeend', page.files.map(f => `
         <div class="file">
+            <input type="checkbox" class="pick" value="${f.id}">
             <div class="file-info">
                 <div class="file-name">${f.filename}</div>
                 <div class="file-meta">${formatSize(f.size)} • ${f.chunks} chunk${f.chunks > 1 ? 's' : ''}</div>
             </div>
             <div>
+                ${isVideo(f.filename) ? `<button class="btn btn-download" onclick="window.open('/api/download/${f.id}?inline=1')">▶️ Play</button>` : ''}
                 <button class="btn btn-download" onclick="downloadFile(${f.id}, '${f.filename}', ${f.size}, ${f.chunks})">⬇️ Download</button>
                 <button class="btn btn-delete" onclick="deleteFile(${f.id})">🗑️</button>
             </div>
         </div>
-    `).join('');
+    `).join(''));
 }
 
+let searchTimer;
+$('search').oninput = () => { clearTimeout(searchTimer); searchTimer = setTimeout(() => loadFiles(), 250); };
+$('typeFilter').onchange = () => loadFiles();
+$('loadMore').onclick = () => loadFiles(true);
+
 async function downloadFile(id, filename, size, numChunks) {
     $('progressContainer').style.display = 'block';
     $('progressBar').style.width = '0%';
     $('progressPercent').textContent = '0%';
     $('statusText').className = 'telegram';
-    
-    // Phase 1: Server fetches all chunks from TG (0-80% fake progress)
-    // TG downloads at ~3 MB/s
-    let fakeProgress = 0;
-    const tgFetchTarget = 80;
-    const tgSpeedBps = 3 * 1024 * 1024; // 3 MB/s
-    const expectedTotalSeconds = Math.max(5, size / tgSpeedBps);
-    const incrementPerTick = tgFetchTarget / expectedTotalSeconds;
-    let elapsed = 0;
-    
-    const fakeInterval = setInterval(() => {
-        elapsed++;
-        if (fakeProgress < tgFetchTarget - 1) {
-            fakeProgress += incrementPerTick;
-            $('progressBar').style.width = fakeProgress.toFixed(1) + '%';
-            $('progressPercent').textContent = fakeProgress.toFixed(1) + '%';
-        }
-        const remaining = Math.max(0, Math.round(expectedTotalSeconds - elapsed));
-        const remMins = Math.floor(remaining / 60);
-        const remSecs = remaining % 60;
-        $('statusText').textContent = `⬇️ Fetching from Telegram... ~${remMins}:${remSecs.toString().padStart(2, '0')} left`;
-    }, 1000);
+    $('statusText').textContent = `⬇️ Connecting to Telegram...`;
     
     try {
-        // Prepare download (server fetches all from TG)
-        const prepRes = await fetch(`/api/download/prepare/${id}`, { method: 'POST' });
-        clearInterval(fakeInterval);
-        
-        if (!prepRes.ok) throw new Error('Prepare failed');
-        
-        // Phase 2: Stream from server to browser (80-100%, smooth and fast)
-        $('statusText').className = '';
-        $('progressBar').style.width = '80%';
-        $('progressPercent').textContent = '80%';
-        $('statusText').textContent = `⬇️ Downloading to browser...`;
-        
+        // Server streams straight from Telegram, so bytes arrive as soon as the first part is fetched
         const res = await fetch(`/api/download/${id}`);
         if (!res.ok) throw new Error('Download failed');
         
@@ -336,6 +535,7 @@ async function downloadFile(id, filename, size, numChunks) {
         const chunks = [];
         let received = 0;
         let startTime = Date.now();
+        $('statusText').className = '';
         
         while (true) {
             const { done, value } = await reader.read();
@@ -343,7 +543,7 @@ async function downloadFile(id, filename, size, numChunks) {
             chunks.push(value);
             received += value.length;
             
-            const realProgress = 80 + (received / size * 20);
+            const realProgress = received / size * 100;
             $('progressBar').style.width = realProgress.toFixed(1) + '%';
             $('progressPercent').textContent = realProgress.toFixed(1) + '%';
             
@@ -352,6 +552,7 @@ async function downloadFile(id, filename, size, numChunks) {
             const remaining = (size - received) / speed;
             $('statusText').textContent = `⬇️ ${formatSize(received)} / ${formatSize(size)} • ${formatSize(speed)}/s • ${formatTime(remaining)} left`;
         }
+        if (received < size) throw new Error('Connection closed early');
         
         $('statusText').textContent = `💾 Saving ${filename}...`;
         const blob = new Blob(chunks);
@@ -363,7 +564,6 @@ async function downloadFile(id, filename, size, numChunks) {
         
         showStatus(`✅ Downloaded ${filename}`, 'success');
     } catch (err) {
-        clearInterval(fakeInterval);
         showStatus(`❌ Download failed: ${err.message}`, 'error');
     }
     
@@ -378,6 +578,25 @@ async function deleteFile(id) {
     loadFiles();
 }
 
+const selectedIds = () => [...document.querySelectorAll('.pick:checked')].map(box => Number(box.value));
+
+function updateSelection() {
+    const count = selectedIds().length;
+    $('deleteSelected').style.display = count ? 'inline-block' : 'none';
+    $('deleteSelected').textContent = `🗑️ Delete ${count} selected`;
+}
+
+$('fileList').onchange = e => { if (e.target.classList.contains('pick')) updateSelection(); };
+$('deleteSelected').onclick = async () => {
+    const ids = selectedIds();
+    if (!confirm(`Delete ${ids.length} file${ids.length > 1 ? 's' : ''}?`)) return;
+    const res = await (await fetch('/api/delete', {
+        method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify({ ids })
+    })).json();
+    showStatus(`✅ Deleted ${res.deleted} file${res.deleted === 1 ? '' : 's'}`, 'success');
+    loadFiles();
+};
+
 loadFiles();
 </script>
 </body>
@@ -386,121 +605,194 @@ loadFiles();
 
 @app.route('/')
 def index():
-    return render_template_string(HTML)
+    storage = get_storage()
+    chunk_size = storage.chunk_size
+    chunk_label = f"{chunk_size / 1024 ** 3:.1f}GB" if chunk_size >= 1024 ** 3 else f"{chunk_size // 1024 ** 2}MB"
+    return render_template_string(HTML, chunk_size=chunk_size, chunk_label=chunk_label, parallel_chunks=storage.upload_concurrency,
+                                  cdc=Chunker(chunk_size).params())
 
 @app.route('/api/files')
 def list_files():
     storage = get_storage()
-    files = storage.list_files()
-    return jsonify([{'id': f[0], 'filename': f[1], 'size': f[2], 'created_at': str(f[3]), 'chunks': f[4]} for f in files])
+    version = storage.library_version()
+    etag = f"v{version}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        key = request.query_string
+        cached = listing_cache.get(key)
+        if not cached or cached[0] != version:
+            if len(listing_cache) >= LISTING_CACHE_SIZE:
+                listing_cache.clear()
+            cached = listing_cache[key] = (version, build_listing(storage))
+        response = jsonify(cached[1])
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def build_listing(storage):
+    limit = max(1, min(request.args.get('limit', LIST_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    before = request.args.get('cursor', type=int)
+    search = request.args.get('q', '').strip() or None
+    extensions = FILE_TYPES.get(request.args.get('type'))
+    # One extra row tells us whether another page exists
+    rows = storage.list_files(limit + 1, before, search, extensions)
+    count, total_size = storage.library_stats(search, extensions)
+    files = [{'id': f[0], 'filename': f[1], 'size': f[2], 'created_at': str(f[3]), 'chunks': f[4]} for f in rows[:limit]]
+    return {
+        'files': files,
+        'next': files[-1]['id'] if len(rows) > limit else None,
+        'count': count,
+        'total_size': total_size,
+    }
 
 @app.route('/api/upload/chunk', methods=['POST'])
 def upload_chunk():
-    upload_id = request.form['upload_id']
-    chunk_index = int(request.form['chunk_index'])
-    total_chunks = int(request.form['total_chunks'])
-    filename = secure_filename(request.form['filename'])
-    total_size = int(request.form['total_size'])
-    chunk = request.files['chunk']
+    """Receive one chunk and send it on to Telegram as it arrives.
+
+    The browser posts the chunk as the raw body with its details in the query string, so
+    the body can be piped through while it is still coming in. Multipart form posts still work.
+    """
+    upload_id = secure_filename(request.values['upload_id'])
+    chunk_index = int(request.values['chunk_index'])
+    total_chunks = int(request.values['total_chunks'])
+    filename = secure_filename(request.values['filename'])
+    total_size = int(request.values['total_size'])
+    storage = get_storage()
     
-    chunk_path = Path(app.config['UPLOAD_FOLDER']) / f"{upload_id}_{chunk_index}"
-    chunk.save(chunk_path)
-    chunk_size = chunk_path.stat().st_size
+    # A retried or resumed chunk that already reached Telegram isn't sent twice
+    if chunk_index in storage.confirmed_chunks(upload_id):
+        return jsonify({'status': 'ok', 'chunk': chunk_index + 1, 'total': total_chunks})
     
-    async def send_to_tg():
-        storage = get_storage()
-        await storage.start()
+    if 'chunk' in request.files:
+        # Werkzeug has already spooled a form upload, so only its size needs finding out
+        source = request.files['chunk'].stream
+        source.seek(0, os.SEEK_END)
+        chunk_size = source.tell()
+        source.seek(0)
+    elif request.content_length is not None:
+        source = request.stream
+        chunk_size = request.content_length
+    else:
+        return jsonify({'error': 'Content-Length required'}), 411
+    
+    # Spooled to disk as it arrives, so a resend after a FloodWait doesn't need the browser again
+    pipe = UploadPipe(Path(app.config['UPLOAD_FOLDER']) / f"{upload_id}_{chunk_index}", chunk_size, get_loop())
+    
+    async def send_to_tg(progress):
         try:
             print(f"Uploading chunk {chunk_index + 1}/{total_chunks} to Telegram...")
-            msg = await storage.client.send_file(storage.channel_id, chunk_path, caption=f"📦 {filename} | {chunk_index + 1}/{total_chunks} | {upload_id}")
+            # A chunk worth compressing waits for all of its body, since its compressed size must be known up front
+            body, stored, codec = await storage.pack(pipe, chunk_size)
+            msg, channel_id, account = await storage.send_chunk(
+                body, f"📦 {filename} | {chunk_index + 1}/{total_chunks} | {upload_id}", stored, progress_callback=progress
+            )
             print(f"Chunk {chunk_index + 1} uploaded successfully, msg_id: {msg.id}")
-            return msg.id
-        except Exception as e:
-            print(f"ERROR uploading to Telegram: {e}")
-            raise
         finally:
-            await storage.stop()
-            if chunk_path.exists(): chunk_path.unlink()
+            pipe.close()
+        
+        # Store in database instead of memory (works across workers)
+        storage.journal_chunk(upload_id, filename, total_size, total_chunks, chunk_index, msg.id, chunk_size, pipe.hexdigest(), msg.document, channel_id, account,
+                              pipe.fingerprint.hexdigest(), codec, stored)
+        return {'chunk': chunk_index + 1, 'message_id': msg.id}
     
+    # The Telegram leg starts now and reads the body as this thread receives it
+    job_id = submit_job('upload', send_to_tg, chunk_size)
+    receiving = saving = 0
     try:
-        msg_id = run_async(send_to_tg())
+        while True:
+            began = time.monotonic()
+            data = source.read(1024 * 1024)
+            received = time.monotonic()
+            receiving += received - began
+            if not data:
+                break
+            pipe.write(data)
+            saving += time.monotonic() - received
+            TRANSFER_BYTES.inc(len(data), direction='from_browser')
+        pipe.finish()
+    except BrokenPipeError:
+        pass  # the send already failed; the job reports why
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
-    
-    # Store in database instead of memory (works across workers)
+        pipe.fail(e)
+        return jsonify({'error': str(e) or type(e).__name__, 'job': job_id}), 400
+    finally:
+        PHASE_SECONDS.observe(receiving, phase='receive')
+        PHASE_SECONDS.observe(saving, phase='disk_save')
+    return jsonify({'status': 'queued', 'job': job_id, 'chunk': chunk_index + 1, 'total': total_chunks}), 202
+
+@app.route('/api/upload/reuse', methods=['POST'])
+def reuse_chunk():
+    """Journal a chunk whose content is already on Telegram instead of receiving it again"""
+    body = request.json
+    upload_id = secure_filename(body['upload_id'])
+    chunk_index = int(body['chunk_index'])
+    size, fingerprint = int(body['size']), str(body['fingerprint'])
     storage = get_storage()
-    storage._q(
-        "INSERT INTO pending_chunks (upload_id, filename, total_size, total_chunks, chunk_index, message_id, chunk_size) VALUES (?, ?, ?, ?, ?, ?, ?)",
-        (upload_id, filename, total_size, total_chunks, chunk_index, msg_id, chunk_size)
+    earlier = storage.confirmed_chunks(upload_id).get(chunk_index)
+    if earlier and (earlier[1], earlier[3]) != (size, fingerprint):
+        # Journaled from different content by an earlier attempt; the sweeper deletes its message
+        storage.drop_chunks(upload_id, [chunk_index])
+        earlier = None
+    reused = bool(earlier) or storage.reuse_chunk(
+        upload_id, secure_filename(body['filename']), int(body['total_size']), int(body['total_chunks']),
+        chunk_index, size, fingerprint
     )
-    
-    return jsonify({'status': 'ok', 'chunk': chunk_index + 1, 'total': total_chunks})
+    return jsonify({'reused': reused})
+
+@app.route('/api/upload/status/<upload_id>')
+def upload_status(upload_id):
+    """Chunk indexes already on Telegram, so an interrupted upload only sends the rest"""
+    storage = get_storage()
+    upload_id = secure_filename(upload_id)
+    stored = storage._q("SELECT id FROM files WHERE hash = ?", (upload_id,), fetch='one')
+    return jsonify({'confirmed': sorted(storage.confirmed_chunks(upload_id)), 'file_id': stored[0] if stored else None})
 
 @app.route('/api/upload/finalize', methods=['POST'])
 def finalize_upload():
-    upload_id = request.json['upload_id']
-    storage = get_storage()
-    
-    # Get all chunks for this upload from database
-    chunks = storage._q(
-        "SELECT filename, total_size, chunk_index, message_id, chunk_size FROM pending_chunks WHERE upload_id = ? ORDER BY chunk_index",
-        (upload_id,), fetch='all'
-    )
+    upload_id = secure_filename(request.json['upload_id'])
+    try:
+        file_id = get_storage().finalize(upload_id)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 409
     
-    if not chunks:
+    if file_id is None:
         return jsonify({'error': 'Upload not found'}), 404
-    
-    filename = chunks[0][0]
-    total_size = chunks[0][1]
-    
-    # Create file record
-    file_id = storage._insert_id("INSERT INTO files (filename, original_size, hash) VALUES (?, ?, ?)", (filename, total_size, upload_id))
-    
-    # Create chunk records
-    for _, _, chunk_idx, msg_id, size in chunks:
-        storage._q("INSERT INTO chunks (file_id, chunk_index, message_id, size) VALUES (?, ?, ?, ?)", (file_id, chunk_idx, msg_id, size))
-    
-    # Clean up pending chunks
-    storage._q("DELETE FROM pending_chunks WHERE upload_id = ?", (upload_id,))
-    
     return jsonify({'file_id': file_id})
 
 @app.route('/api/download/prepare/<int:file_id>', methods=['POST'])
 def prepare_download(file_id):
-    """Download all chunks from TG to server, return when ready"""
+    """Start downloading all chunks from TG to server; poll the returned job until ready"""
     storage = get_storage()
     file_info = storage._q("SELECT filename, original_size FROM files WHERE id = ?", (file_id,), fetch='one')
     if not file_info:
         return jsonify({'error': 'File not found'}), 404
     
     filename, original_size = file_info
-    chunks = storage._q("SELECT message_id, chunk_index FROM chunks WHERE file_id = ? ORDER BY chunk_index", (file_id,), fetch='all')
-    
     output_path = Path(f"/tmp/downloads/ready_{file_id}_{filename}")
     
-    async def download_all():
-        s = get_storage()
-        await s.start()
-        try:
-            with open(output_path, 'wb') as out:
-                for msg_id, idx in chunks:
-                    print(f"Downloading chunk {idx + 1}/{len(chunks)} from TG for file {file_id}")
-                    msg = await s.client.get_messages(s.channel_id, ids=msg_id)
-                    temp = Path(f"/tmp/downloads/dl_{file_id}_{idx}")
-                    await s.client.download_media(msg, file=str(temp))
-                    with open(temp, 'rb') as f:
-                        out.write(f.read())
-                    temp.unlink()
-                    print(f"Chunk {idx + 1}/{len(chunks)} done")
-        finally:
-            await s.stop()
+    if storage.cache and storage.cache.cacheable(original_size):
+        # Download then streams from the shared chunk cache, which outlives this one request
+        async def warm(progress):
+            await storage.warm(file_id, progress)
+            return {'ready': True, 'cached': True}
+        
+        print(f"Caching file {file_id} from TG")
+        return jsonify({'job': submit_job('prepare', warm, original_size, key=file_id)}), 202
+    
+    async def fetch(progress):
+        # Written under a temporary name so /api/download never serves a half-fetched file
+        part_path = output_path.with_name(output_path.name + '.part')
+        await storage.fetch_to(file_id, part_path, progress)
+        os.replace(part_path, output_path)
+        return {'ready': True, 'path': str(output_path)}
     
-    run_async(download_all())
-    return jsonify({'ready': True, 'path': str(output_path)})
+    print(f"Downloading file {file_id} from TG")
+    return jsonify({'job': submit_job('prepare', fetch, original_size, key=file_id)}), 202
 
 @app.route('/api/download/<int:file_id>')
 def download(file_id):
-    """Stream the prepared file to browser"""
+    """Stream a file to the browser, straight from Telegram unless it was prepared; honours Range"""
     storage = get_storage()
     file_info = storage._q("SELECT filename, original_size FROM files WHERE id = ?", (file_id,), fetch='one')
     if not file_info:
@@ -508,49 +800,101 @@ def download(file_id):
     
     filename, original_size = file_info
     output_path = Path(f"/tmp/downloads/ready_{file_id}_{filename}")
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    disposition = 'inline' if request.args.get('inline') else 'attachment'
+    headers = {'Content-Disposition': f'{disposition}; filename="{filename}"', 'Accept-Ranges': 'bytes'}
     
-    # If not prepared, prepare now (blocking)
-    if not output_path.exists():
-        chunks = storage._q("SELECT message_id, chunk_index FROM chunks WHERE file_id = ? ORDER BY chunk_index", (file_id,), fetch='all')
-        
-        async def download_all():
-            s = get_storage()
-            await s.start()
-            try:
-                with open(output_path, 'wb') as out:
-                    for msg_id, idx in chunks:
-                        print(f"Downloading chunk {idx + 1}/{len(chunks)} from TG")
-                        msg = await s.client.get_messages(s.channel_id, ids=msg_id)
-                        temp = Path(f"/tmp/downloads/dl_{file_id}_{idx}")
-                        await s.client.download_media(msg, file=str(temp))
-                        with open(temp, 'rb') as f:
-                            out.write(f.read())
-                        temp.unlink()
-            finally:
-                await s.stop()
-        
-        run_async(download_all())
+    # Multi-range requests are answered with the whole file, which RFC 9110 allows
+    if request.range and len(request.range.ranges) == 1:
+        # Seeking only fetches the byte span of the chunks it falls in
+        span = request.range.range_for_length(original_size)
+        if span is None:
+            return Response(status=416, headers={'Content-Range': f'bytes */{original_size}', 'Accept-Ranges': 'bytes'})
+        start, stop = span
+        headers.update({'Content-Range': f'bytes {start}-{stop - 1}/{original_size}', 'Content-Length': str(stop - start)})
+        return Response(iter_async(storage.stream(file_id, start, stop)), status=206, mimetype=mimetype, headers=headers)
+    
+    headers['Content-Length'] = str(original_size)
+    try:
+        f = open(output_path, 'rb')
+    except FileNotFoundError:
+        return Response(iter_async(storage.stream(file_id)), mimetype=mimetype, headers=headers)
+    # Other viewers of the same prepare read it too, so it stays until the sweeper finds it unused for READY_TTL_HOURS
+    os.utime(output_path)
     
     def generate():
-        with open(output_path, 'rb') as f:
+        with f:
             while data := f.read(1024 * 1024):
                 yield data
-        # Clean up after streaming
-        output_path.unlink()
     
-    return Response(generate(), mimetype='application/octet-stream', headers={'Content-Disposition': f'attachment; filename="{filename}"', 'Content-Length': str(original_size)})
+    return Response(generate(), mimetype=mimetype, headers=headers)
+
+def delete_now(file_ids):
+    """Drop files from the library immediately; their Telegram messages are removed in the background"""
+    storage = get_storage()
+    deleted = storage.delete_files(file_ids)
+    for file_id in file_ids:
+        for path in Path('/tmp/downloads').glob(f'ready_{file_id}_*'):
+            path.unlink(missing_ok=True)
+    if deleted:
+        asyncio.run_coroutine_threadsafe(storage.drain_deletes(), get_loop())
+    return deleted
 
 @app.route('/api/delete/<int:file_id>', methods=['DELETE'])
 def delete(file_id):
-    async def do_del():
-        s = get_storage()
-        await s.start()
+    if not delete_now([file_id]):
+        return jsonify({'error': 'File not found'}), 404
+    return jsonify({'deleted': 1})
+
+@app.route('/api/delete', methods=['POST'])
+def delete_many():
+    """Delete the files in `ids`, or every file matching the listing filters `q` and `type`"""
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        body = {}
+    if 'ids' in body:
+        # A string would be taken apart into single-digit ids, so only a list will do
         try:
-            await s.delete(file_id)
-        finally:
-            await s.stop()
-    run_async(do_del())
-    return jsonify({'deleted': file_id})
+            if not isinstance(body['ids'], list):
+                raise TypeError
+            file_ids = [int(file_id) for file_id in body['ids']]
+        except (TypeError, ValueError):
+            return jsonify({'error': 'ids must be a list of file ids'}), 400
+    elif body.get('q') or body.get('type') in FILE_TYPES:
+        file_ids = get_storage().find_files(body.get('q') or None, FILE_TYPES.get(body.get('type')))
+    else:
+        return jsonify({'error': 'ids or a q/type filter is required'}), 400
+    return jsonify({'deleted': delete_now(file_ids)})
+
+@app.route('/api/jobs/<job_id>')
+def job_status(job_id):
+    job = get_storage().get_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@app.route('/api/jobs/<job_id>/events')
+def job_events(job_id):
+    """Server-Sent Events feed of a job's bytes, rate and ETA until it finishes"""
+    storage = get_storage()
+    
+    def generate():
+        while True:
+            job = storage.get_job(job_id)
+            if not job:
+                yield f"data: {json.dumps({'error': 'Job not found'})}\n\n"
+                return
+            yield f"data: {json.dumps(job)}\n\n"
+            if job['status'] != 'running':
+                return
+            time.sleep(1)
+    
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus metrics, summed over every worker of this server"""
+    return Response(metrics.render(metrics.collect()), mimetype='text/plain; version=0.0.4')
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 5000)), debug=False)
@@ -0,0 +1,465 @@
+#!/usr/bin/env python3
+"""
+TG Cloud benchmark
+Runs upload, download, list and delete through the CLI code path and the Flask routes
+against a local stand-in for Telegram, so speed changes can be measured without an account.
+
+    python bench.py --sizes 8,64 --concurrency 1,4 --latency 50 --bandwidth 20
+"""
+import os
+import io
+import sys
+import json
+import math
+import time
+import uuid
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import threading
+import contextlib
+from pathlib import Path
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+from telethon.errors import FloodWaitError
+from telethon.sessions import StringSession
+from telethon.tl.types import Document
+
+PART_SIZE = 512 * 1024  # bytes per simulated upload part or download request
+
+class FakeTelegram:
+    """Shared state of the simulated Telegram: channels of messages whose documents are files in `store`"""
+    def __init__(self, store, latency=0.05, bandwidth=20 * 1024 * 1024, flood=0.0, flood_seconds=1):
+        self.store = Path(store)
+        self.store.mkdir(parents=True, exist_ok=True)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.flood = flood
+        self.flood_seconds = flood_seconds
+        self.messages = {}
+        self.next_id = {}
+        self.next_doc = 1000
+        self.floods = 0
+        self.lock = threading.Lock()
+
+    def path(self, doc_id):
+        return self.store / str(doc_id)
+
+class FakeTelegramClient:
+    """Drop-in for the parts of TelegramClient TelegramStorage uses.
+
+    Each request costs `latency`; bytes move over one link per connection capped at `bandwidth`,
+    shared by that connection's concurrent requests as MTProto shares its socket. Requests fail
+    with a FloodWait at rate `flood`.
+    """
+    backend = None
+
+    def __init__(self, session, api_id=None, api_hash=None, **kwargs):
+        if not isinstance(session, StringSession):
+            # File sessions get a fixed login, so extra connections clone the same account
+            session = StringSession(make_session(0))
+        self.session = session
+        self.connected = False
+        self.link_free = 0.0
+
+    async def connect(self):
+        self.connected = True
+
+    async def disconnect(self):
+        self.connected = False
+
+    def is_connected(self):
+        return self.connected
+
+    async def is_user_authorized(self):
+        return True
+
+    async def get_me(self, input_peer=False):
+        return SimpleNamespace(id=int.from_bytes(self.session.auth_key.key[:4], 'big'))
+
+    async def _request(self, nbytes=0):
+        backend = self.backend
+        if backend.flood and random.random() < backend.flood:
+            backend.floods += 1
+            raise FloodWaitError(request=None, capture=backend.flood_seconds)
+        now = time.monotonic()
+        start = max(now, self.link_free)
+        self.link_free = start + nbytes / backend.bandwidth
+        await asyncio.sleep(backend.latency + self.link_free - now)
+
+    async def send_file(self, entity, file, caption=None, attributes=None, force_document=False, file_size=None, progress_callback=None, **kwargs):
+        backend = self.backend
+        with backend.lock:
+            backend.next_doc += 1
+            doc_id = backend.next_doc
+        source = open(file, 'rb') if isinstance(file, (str, Path)) else file
+        sent = 0
+        try:
+            with open(backend.path(doc_id), 'wb') as out:
+                while file_size is None or sent < file_size:
+                    part = source.read(PART_SIZE if file_size is None else min(PART_SIZE, file_size - sent))
+                    if asyncio.iscoroutine(part):
+                        part = await part
+                    if not part:
+                        break
+                    await self._request(len(part))
+                    out.write(part)
+                    sent += len(part)
+                    if progress_callback:
+                        result = progress_callback(sent, file_size or sent)
+                        if asyncio.iscoroutine(result):
+                            await result
+        except BaseException:
+            backend.path(doc_id).unlink(missing_ok=True)
+            raise
+        finally:
+            if source is not file:
+                source.close()
+
+        with backend.lock:
+            msg_id = backend.next_id[entity] = backend.next_id.get(entity, 0) + 1
+        document = Document(id=doc_id, access_hash=random.getrandbits(62), file_reference=os.urandom(16), date=None,
+                            mime_type='application/octet-stream', size=sent, dc_id=2, attributes=attributes or [])
+        msg = SimpleNamespace(id=msg_id, document=document, message=caption, file=SimpleNamespace(size=sent))
+        backend.messages[(entity, msg_id)] = msg
+        return msg
+
+    async def get_messages(self, entity, ids=None, **kwargs):
+        await self._request()
+        if isinstance(ids, list):
+            return [self.backend.messages.get((entity, i)) for i in ids]
+        return self.backend.messages.get((entity, ids))
+
+    async def download_media(self, msg, file=None, progress_callback=None):
+        async for data in self.iter_download(msg.document):
+            with open(file, 'ab') as out:
+                out.write(data)
+        return file
+
+    def iter_download(self, file, *, offset=0, request_size=PART_SIZE, limit=None, dc_id=None, **kwargs):
+        client = self
+        path = self.backend.path(file.id)
+
+        class Download:
+            def __init__(self):
+                self.pos = offset
+                self.requests = 0
+
+            def __aiter__(self):
+                return self
+
+            async def __anext__(self):
+                if limit is not None and self.requests >= limit:
+                    raise StopAsyncIteration
+                with open(path, 'rb') as f:
+                    data = os.pread(f.fileno(), request_size, self.pos)
+                if not data:
+                    raise StopAsyncIteration
+                await client._request(len(data))
+                self.pos += len(data)
+                self.requests += 1
+                return data
+
+            async def close(self):
+                pass
+
+        return Download()
+
+    async def delete_messages(self, entity, ids, **kwargs):
+        await self._request()
+        for msg_id in ids if isinstance(ids, list) else [ids]:
+            msg = self.backend.messages.pop((entity, msg_id), None)
+            if msg:
+                self.backend.path(msg.document.id).unlink(missing_ok=True)
+
+def make_session(account):
+    """A StringSession for simulated account number `account`"""
+    key = account.to_bytes(4, 'big') + bytes(252)
+    session = SimpleNamespace(dc_id=2, server_address='127.0.0.1', port=443, auth_key=SimpleNamespace(key=key))
+    return StringSession.save(session)
+
+class Sampler:
+    """Peak resident memory of this process and peak growth of bytes under `dirs`, sampled in the background"""
+    def __init__(self, dirs, interval=0.05):
+        self.dirs = [Path(d) for d in dirs]
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_disk = 0
+        self.base_disk = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def rss(self):
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except OSError:
+            import resource
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+    def disk(self):
+        total = 0
+        for d in self.dirs:
+            for root, _, files in os.walk(d):
+                for name in files:
+                    try:
+                        total += os.stat(os.path.join(root, name)).st_size
+                    except FileNotFoundError:
+                        pass
+        return total
+
+    def sample(self):
+        self.peak_rss = max(self.peak_rss, self.rss())
+        self.peak_disk = max(self.peak_disk, self.disk())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        # Files left in the shared temp folders by earlier runs don't count
+        self.base_disk = self.disk()
+        self.sample()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)] if ordered else 0
+
+def make_sources(directory, size, count):
+    """`count` files of random bytes, so quick dedup never short-circuits an upload"""
+    directory.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for i in range(count):
+        path = directory / f"bench_{size}_{i}_{uuid.uuid4().hex[:8]}.bin"
+        with open(path, 'wb') as f:
+            for start in range(0, size, 1024 * 1024):
+                f.write(os.urandom(min(1024 * 1024, size - start)))
+        paths.append(path)
+    return paths
+
+def measure(path, op, size, concurrency, run, dirs, nbytes=None):
+    """Time run() -> list of per-operation latencies and report throughput, percentiles and peaks"""
+    with Sampler(dirs) as sampler:
+        began = time.monotonic()
+        latencies = run()
+        wall = time.monotonic() - began
+    moved = nbytes if nbytes is not None else 0
+    return {
+        'path': path, 'op': op, 'size': size, 'concurrency': concurrency, 'ops': len(latencies),
+        'mb_per_s': moved / wall / 1024 / 1024 if moved and wall else None,
+        'p50_ms': percentile(latencies, 50) * 1000, 'p99_ms': percentile(latencies, 99) * 1000,
+        'peak_rss_mb': sampler.peak_rss / 1024 / 1024, 'peak_disk_mb': (sampler.peak_disk - sampler.base_disk) / 1024 / 1024,
+        'seconds': wall,
+    }
+
+def bench_cli(storage, loop, work, size, concurrency, dirs, list_calls):
+    """The calls cli.py makes, `concurrency` files at a time on one event loop"""
+    sources = make_sources(work / 'src', size, concurrency)
+    out = work / 'out'
+    out.mkdir(exist_ok=True)
+    results = []
+    ids = []
+
+    def timed_all(make, items):
+        """Run make(item) for every item at once; returns each one's latency"""
+        async def one(item):
+            began = time.monotonic()
+            await make(item)
+            return time.monotonic() - began
+
+        async def run():
+            return await asyncio.gather(*(one(item) for item in items))
+        return loop.run_until_complete(run())
+
+    async def upload(path):
+        ids.append(await storage.upload(path))
+
+    results.append(measure('cli', 'upload', size, concurrency, lambda: timed_all(upload, sources), dirs, size * concurrency))
+    results.append(measure('cli', 'download', size, concurrency,
+                           lambda: timed_all(lambda fid: storage.download(fid, out / str(fid)), ids), dirs, size * concurrency))
+    shutil.rmtree(out, ignore_errors=True)
+
+    def list_files():
+        latencies = []
+        for _ in range(list_calls):
+            began = time.monotonic()
+            storage.list_files()
+            latencies.append(time.monotonic() - began)
+        return latencies
+    results.append(measure('cli', 'list', size, concurrency, list_files, dirs))
+
+    async def delete(fid):
+        storage.delete_files([fid])
+        await storage.drain_deletes()
+    results.append(measure('cli', 'delete', size, concurrency, lambda: timed_all(delete, ids), dirs))
+
+    for path in sources:
+        path.unlink()
+    return results
+
+def bench_web(appmod, work, size, concurrency, dirs, list_calls):
+    """The browser's calls against the Flask routes, `concurrency` requests at a time"""
+    from tg_storage import FileWindow, scan_chunks
+    client = appmod.app.test_client()
+    storage = appmod.get_storage()
+    chunk_size = storage.chunk_size
+    sources = make_sources(work / 'src', size, concurrency)
+    results = []
+    ids = []
+
+    def wait(job_id):
+        while True:
+            job = client.get(f'/api/jobs/{job_id}').get_json()
+            if job['status'] == 'done':
+                return
+            if job['status'] != 'running':
+                raise RuntimeError(f"Upload job failed: {job['error']}")
+            time.sleep(0.02)
+
+    def upload(path):
+        began = time.monotonic()
+        upload_id = uuid.uuid4().hex
+        # Cut and fingerprinted the way the page script does, then each chunk is offered for reuse first
+        chunks = []
+        scan_chunks(path, chunk_size, lambda *chunk: chunks.append(chunk))
+        for index, (start, length, fingerprint) in enumerate(chunks):
+            fields = {'upload_id': upload_id, 'chunk_index': index, 'total_chunks': len(chunks), 'filename': path.name, 'total_size': size}
+            if client.post('/api/upload/reuse', json={**fields, 'size': length, 'fingerprint': fingerprint}).get_json()['reused']:
+                continue
+            query = '&'.join(f"{key}={value}" for key, value in fields.items())
+            # Streamed from the source file like a browser Blob, not held in memory
+            with FileWindow(path, start, length) as body:
+                r = client.post(f'/api/upload/chunk?{query}', input_stream=body, content_type='application/octet-stream')
+            if r.status_code == 202:
+                wait(r.get_json()['job'])
+            elif r.status_code != 200:
+                raise RuntimeError(f"Chunk upload failed: {r.status_code} {r.get_data(as_text=True)}")
+        r = client.post('/api/upload/finalize', json={'upload_id': upload_id})
+        ids.append(r.get_json()['file_id'])
+        return time.monotonic() - began
+
+    def download(file_id):
+        began = time.monotonic()
+        r = client.get(f'/api/download/{file_id}', buffered=False)
+        received = sum(len(data) for data in r.iter_encoded())
+        r.close()
+        if received != size:
+            raise RuntimeError(f"Downloaded {received} of {size} bytes")
+        return time.monotonic() - began
+
+    def delete(file_id):
+        began = time.monotonic()
+        client.post('/api/delete', json={'ids': [file_id]})
+        return time.monotonic() - began
+
+    def list_files(_):
+        began = time.monotonic()
+        client.get('/api/files')
+        return time.monotonic() - began
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        results.append(measure('web', 'upload', size, concurrency, lambda: list(pool.map(upload, sources)), dirs, size * concurrency))
+        results.append(measure('web', 'download', size, concurrency, lambda: list(pool.map(download, ids)), dirs, size * concurrency))
+        results.append(measure('web', 'list', size, concurrency, lambda: list(pool.map(list_files, range(list_calls))), dirs))
+        results.append(measure('web', 'delete', size, concurrency, lambda: list(pool.map(delete, ids)), dirs))
+
+    # Deletes finish on the app's loop; let them drain so the next run starts clean
+    appmod.run_async(storage.drain_deletes())
+    for path in sources:
+        path.unlink()
+    return results
+
+def report(results, backend):
+    print(f"\n{'Path':<5} {'Op':<9} {'Size':>7} {'Conc':>5} {'MB/s':>8} {'p50 ms':>9} {'p99 ms':>9} {'RSS MB':>8} {'Disk MB':>8}")
+    print("-" * 78)
+    for r in results:
+        rate = f"{r['mb_per_s']:.1f}" if r['mb_per_s'] else '-'
+        print(f"{r['path']:<5} {r['op']:<9} {r['size'] / 1024 / 1024:>5.0f}MB {r['concurrency']:>5} {rate:>8} "
+              f"{r['p50_ms']:>9.1f} {r['p99_ms']:>9.1f} {r['peak_rss_mb']:>8.0f} {r['peak_disk_mb']:>8.0f}")
+    if backend.floods:
+        print(f"\nSimulated FloodWaits: {backend.floods}")
+
+def main():
+    parser = argparse.ArgumentParser(description='TG Cloud benchmark against a simulated Telegram')
+    parser.add_argument('--sizes', default='8,64', help='File sizes in MB (comma-separated)')
+    parser.add_argument('--concurrency', default='1,4', help='Files transferred at once (comma-separated)')
+    parser.add_argument('--paths', default='cli,web', help='Code paths to drive: cli, web or both')
+    parser.add_argument('--latency', type=float, default=50, help='Simulated round trip per request in ms')
+    parser.add_argument('--bandwidth', type=float, default=20, help='Simulated MB/s per connection')
+    parser.add_argument('--flood', type=float, default=0, help='Chance of a FloodWait per request (0-1)')
+    parser.add_argument('--flood-seconds', type=int, default=1, help='Length of each simulated FloodWait')
+    parser.add_argument('--accounts', type=int, default=1, help='Simulated Telegram accounts')
+    parser.add_argument('--pool-size', type=int, default=2, help='Connections per account')
+    parser.add_argument('--chunk-size', type=int, default=16, help='Chunk size in MB')
+    parser.add_argument('--list-calls', type=int, default=50, help='Listing requests timed per run')
+    parser.add_argument('--json', help='Also write the results to this file, for comparing runs')
+    parser.add_argument('--verbose', '-v', action='store_true', help="Show the storage layer's own output")
+    args = parser.parse_args()
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    work = Path(tempfile.mkdtemp(prefix='tgbench_'))
+    backend = FakeTelegram(work / 'telegram', args.latency / 1000, args.bandwidth * 1024 * 1024, args.flood, args.flood_seconds)
+    FakeTelegramClient.backend = backend
+
+    import tg_storage
+    tg_storage.TelegramClient = FakeTelegramClient
+    os.environ.update({
+        'TG_API_ID': '1', 'TG_API_HASH': 'bench', 'TG_CHANNEL_ID': '-1001',
+        'TG_SESSIONS': ','.join(make_session(i) for i in range(1, args.accounts + 1)),
+        'TG_POOL_SIZE': str(args.pool_size), 'TG_CHUNK_SIZE': str(args.chunk_size * 1024 * 1024),
+    })
+    for name in ('DATABASE_URL', 'TG_SESSION', 'TG_CHANNEL_IDS', 'TG_CACHE_BYTES'):
+        os.environ.pop(name, None)
+    os.chdir(work)
+
+    sizes = [int(float(s) * 1024 * 1024) for s in args.sizes.split(',')]
+    levels = [int(c) for c in args.concurrency.split(',')]
+    paths = args.paths.split(',')
+    # Everything local the transfers write: sources excluded, simulated Telegram excluded
+    dirs = [work / 'out', Path('/tmp/uploads'), Path('/tmp/downloads')]
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    print(f"Simulating {args.accounts} account(s) x {args.pool_size} connections at {args.bandwidth} MB/s and "
+          f"{args.latency:.0f} ms per request, {args.chunk_size} MB chunks; working in {work}")
+
+    results = []
+    try:
+        if 'cli' in paths:
+            loop = asyncio.new_event_loop()
+            storage = tg_storage.TelegramStorage(pool_size=args.pool_size)
+            with quiet:
+                loop.run_until_complete(storage.start())
+            try:
+                for size in sizes:
+                    for concurrency in levels:
+                        with quiet:
+                            results += bench_cli(storage, loop, work, size, concurrency, dirs, args.list_calls)
+                        print(f"  cli {size // 1024 // 1024}MB x{concurrency} done")
+            finally:
+                loop.run_until_complete(storage.stop())
+                loop.close()
+        if 'web' in paths:
+            import app as appmod
+            for size in sizes:
+                for concurrency in levels:
+                    with quiet:
+                        results += bench_web(appmod, work, size, concurrency, dirs, args.list_calls)
+                    print(f"  web {size // 1024 // 1024}MB x{concurrency} done")
+    finally:
+        report(results, backend)
+        if json_path:
+            with open(json_path, 'w') as f:
+                json.dump({'settings': vars(args), 'results': results}, f, indent=2)
+        shutil.rmtree(work, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+"""
+Local chunk cache
+Keeps recently downloaded chunks on disk under a byte budget so repeat downloads skip Telegram.
+Safe to share between worker processes: entries appear by atomic rename and fills are guarded by lock files.
+"""
+import os
+import time
+import fcntl
+import struct
+from pathlib import Path
+
+STALE_TEMP_SECONDS = 24 * 3600
+
+MARK = struct.Struct('<q')
+
+class ChunkWriter:
+    """In-progress fill of one chunk; becomes a cache entry only on commit().
+
+    Other requests can read it while it grows: the .mark file holds how many leading bytes are already written.
+    """
+    def __init__(self, cache, key, size, lock):
+        self.cache = cache
+        self.key = key
+        self.size = size
+        self.lock = lock
+        self.mark = open(cache.directory / f"{key}.mark", 'wb')
+        self.mark.write(MARK.pack(0))
+        self.mark.flush()
+        self.tmp = cache.directory / f"{key}.fill"
+        self.file = open(self.tmp, 'w+b')
+        self.file.truncate(size)
+        self.written = 0
+        self.ready = 0
+        self.pieces = {}
+
+    def write(self, data):
+        """Append in order (streaming fills)"""
+        self.write_at(self.written, data)
+
+    def write_at(self, offset, data):
+        """Write out of order (concurrent range fills)"""
+        self.file.seek(offset)
+        self.file.write(data)
+        self.written += len(data)
+        self.pieces[offset] = offset + len(data)
+        if offset == self.ready:
+            while self.ready in self.pieces:
+                self.ready = self.pieces.pop(self.ready)
+            self.file.flush()
+            os.pwrite(self.mark.fileno(), MARK.pack(self.ready), 0)
+
+    def read_at(self, offset, length):
+        """Read back bytes already written, e.g. to checksum them"""
+        self.file.flush()
+        return os.pread(self.file.fileno(), length, offset)
+
+    def commit(self):
+        if self.written != self.size:
+            raise EOFError(f"Cache fill of {self.key} got {self.written} of {self.size} bytes")
+        self.file.close()
+        os.replace(self.tmp, self.cache.path(self.key))
+        self._release()
+        self.cache.evict()
+
+    def abort(self):
+        if self.lock is None:
+            return
+        self.file.close()
+        self.tmp.unlink(missing_ok=True)
+        self._release()
+
+    def _release(self):
+        self.mark.close()
+        (self.cache.directory / f"{self.key}.mark").unlink(missing_ok=True)
+        fcntl.flock(self.lock, fcntl.LOCK_UN)
+        self.lock.close()
+        self.lock = None
+
+class ChunkFollower:
+    """Read side of another request's ChunkWriter, possibly in another worker"""
+    def __init__(self, cache, key, mark, file):
+        self.cache = cache
+        self.key = key
+        self.mark = mark
+        self.file = file
+
+    def available(self):
+        """Leading bytes of the chunk that can be read so far"""
+        return MARK.unpack(os.pread(self.mark.fileno(), MARK.size, 0))[0]
+
+    def active(self):
+        """False once the writer has committed, aborted or died"""
+        return self.cache.filling(self.key)
+
+    def read(self, offset, length):
+        return os.pread(self.file.fileno(), length, offset)
+
+    def close(self):
+        self.mark.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class ChunkCache:
+    def __init__(self, directory=None, max_bytes=None):
+        self.directory = Path(directory or os.environ.get('TG_CACHE_DIR', '/tmp/tg_cache'))
+        self.max_bytes = int(max_bytes or os.environ.get('TG_CACHE_BYTES', 0))
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def path(self, key):
+        return self.directory / f"{key}.chunk"
+
+    def cacheable(self, size):
+        return size <= self.max_bytes
+
+    def contains(self, key):
+        return self.path(key).exists()
+
+    def open(self, key):
+        """Open file of a cached chunk, or None on a miss; a hit counts as a use for eviction"""
+        try:
+            f = open(self.path(key), 'rb')
+        except FileNotFoundError:
+            return None
+        os.utime(f.fileno())
+        return f
+
+    def filling(self, key):
+        """Whether some request currently holds the fill lock for key"""
+        try:
+            lock = open(self.directory / f"{key}.lock", 'rb')
+        except FileNotFoundError:
+            return False
+        with lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            return False
+
+    def follow(self, key):
+        """A ChunkFollower on the fill of key in progress, or None if nobody is filling it"""
+        if not self.filling(key):
+            return None
+        # The mark is opened first: while it exists the fill file has not been renamed away yet
+        try:
+            mark = open(self.directory / f"{key}.mark", 'rb')
+        except FileNotFoundError:
+            return None
+        try:
+            file = open(self.directory / f"{key}.fill", 'rb')
+        except FileNotFoundError:
+            try:
+                file = open(self.path(key), 'rb')
+            except FileNotFoundError:
+                mark.close()
+                return None
+        return ChunkFollower(self, key, mark, file)
+
+    def writer(self, key, size):
+        """A ChunkWriter holding the fill lock for key, or None if another request is already filling it"""
+        if not self.cacheable(size):
+            return None
+        lock = open(self.directory / f"{key}.lock", 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            return None
+        if self.contains(key):
+            # Finished between our miss and taking the lock
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+            return None
+        self.evict(reserve=size)
+        return ChunkWriter(self, key, size, lock)
+
+    def discard(self, key):
+        self.path(key).unlink(missing_ok=True)
+        (self.directory / f"{key}.lock").unlink(missing_ok=True)
+
+    def evict(self, reserve=0):
+        """Delete least recently used chunks until the cache plus `reserve` bytes fits the budget"""
+        with open(self.directory / ".evict.lock", 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = []
+            for path in self.directory.iterdir():
+                try:
+                    st = path.stat()
+                except FileNotFoundError:
+                    continue
+                if path.suffix == '.chunk':
+                    entries.append((st.st_mtime, st.st_size, path))
+                elif path.suffix in ('.fill', '.mark') and st.st_mtime < time.time() - STALE_TEMP_SECONDS and not self.filling(path.stem):
+                    # Left behind by a worker that died mid-fill
+                    path.unlink(missing_ok=True)
+            used = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if used + reserve <= self.max_bytes:
+                    break
+                self.discard(path.stem)
+                used -= size
@@ -4,26 +4,172 @@ TG Cloud CLI - Bulk upload/download for video libraries
 """
 import os
 import sys
+import json
+import time
 import asyncio
 import argparse
+from collections import deque
 from pathlib import Path
-from tg_storage import TelegramStorage
+from tg_storage import TelegramStorage, Progress
+import metrics
+
+MANIFEST_NAME = '.tgcloud-manifest.json'
+
+def show_progress(progress):
+    print(f"\r  {progress.describe()}   ", end='', flush=True)
+
+def scan(dir_path, extensions):
+    """Single walk of the tree, returning (path, size, mtime) for every matching file"""
+    extensions = {e.lower() for e in extensions}
+    found = []
+    for root, _, names in os.walk(dir_path):
+        for name in names:
+            if os.path.splitext(name)[1].lower() in extensions:
+                path = Path(root) / name
+                st = path.stat()
+                found.append((path, st.st_size, st.st_mtime))
+    return sorted(found)
+
+def load_manifest(path):
+    try:
+        return json.loads(Path(path).read_text())
+    except FileNotFoundError:
+        return {}
+
+def save_manifest(path, manifest):
+    tmp = Path(f"{path}.tmp")
+    tmp.write_text(json.dumps(manifest, indent=1))
+    os.replace(tmp, path)
+
+def pipe_order(videos):
+    """Largest first, alternating with the smallest, so short files fill the gaps around long transfers"""
+    by_size = deque(sorted(videos, key=lambda v: v[1], reverse=True))
+    ordered = []
+    while by_size:
+        ordered.append(by_size.popleft())
+        if by_size:
+            ordered.append(by_size.pop())
+    return ordered
+
+async def bulk_upload(storage, dir_path, extensions, jobs, manifest_path, quick_dedup=True, pack=True):
+    manifest = load_manifest(manifest_path)
+    videos = scan(dir_path, extensions)
+    total_size = sum(v[1] for v in videos)
+    
+    # Files whose size and mtime match the manifest were stored by an earlier run
+    todo = []
+    for video, size, mtime in videos:
+        entry = manifest.get(str(video.relative_to(dir_path)))
+        if not entry or entry['size'] != size or entry['mtime'] != mtime:
+            todo.append((video, size, mtime))
+    todo_size = sum(v[1] for v in todo)
+    
+    print(f"\n📁 Found {len(videos)} videos ({total_size / (1024**3):.2f} GB), "
+          f"{len(videos) - len(todo)} already stored, {len(todo)} to upload ({todo_size / (1024**3):.2f} GB)")
+    print("-" * 50)
+    
+    sent = {}
+    failed = []
+    started = time.monotonic()
+    limit = asyncio.Semaphore(jobs)
+    
+    def report():
+        done = sum(sent.values())
+        elapsed = time.monotonic() - started
+        rate = done / elapsed if elapsed else 0
+        eta = (todo_size - done) / rate if rate else 0
+        print(f"📊 {done / (1024**3):.2f} / {todo_size / (1024**3):.2f} GB • {rate / 1024 / 1024:.1f} MB/s • ~{eta / 60:.0f} min left")
+    
+    async def reporter():
+        while True:
+            await asyncio.sleep(30)
+            report()
+    
+    # Small files share pack messages instead of costing one each
+    small = [v for v in todo if pack and 0 < v[1] < storage.pack_threshold]
+    large = [v for v in todo if not (pack and 0 < v[1] < storage.pack_threshold)]
+    
+    async def upload_one(i, video, size, mtime):
+        async with limit:
+            print(f"\n[{i}/{len(large)}] {video.name} ({size / (1024**3):.2f} GB)")
+            def on_progress(done, _total):
+                sent[video] = done
+            
+            try:
+                file_id = await storage.upload(str(video), progress_callback=on_progress, quick_dedup=quick_dedup)
+            except Exception as e:
+                print(f"❌ Error: {video.name}: {e}")
+                failed.append(video)
+                return
+            sent[video] = size
+            manifest[str(video.relative_to(dir_path))] = {'size': size, 'mtime': mtime, 'file_id': file_id}
+            save_manifest(manifest_path, manifest)
+    
+    async def upload_small():
+        if not small:
+            return
+        print(f"\n📦 Packing {len(small)} small files ({sum(v[1] for v in small) / (1024**2):.1f} MB)")
+        found = {video: (size, mtime) for video, size, mtime in small}
+        
+        def on_stored(video, file_id):
+            size, mtime = found[video]
+            sent[video] = size
+            manifest[str(video.relative_to(dir_path))] = {'size': size, 'mtime': mtime, 'file_id': file_id}
+        
+        try:
+            await storage.upload_packed(list(found), on_stored)
+        except Exception as e:
+            print(f"❌ Error packing small files: {e}")
+            failed.extend(video for video in found if video not in sent)
+        finally:
+            save_manifest(manifest_path, manifest)
+    
+    ticker = asyncio.ensure_future(reporter())
+    try:
+        await asyncio.gather(upload_small(), *(upload_one(i, *v) for i, v in enumerate(pipe_order(large), 1)))
+    finally:
+        ticker.cancel()
+    
+    report()
+    if failed:
+        print(f"\n⚠️ {len(failed)} failed, rerun to retry: " + ", ".join(v.name for v in failed))
+    print(f"\n✅ Bulk upload complete!")
 
 async def main():
     parser = argparse.ArgumentParser(description='TG Cloud - Telegram Storage CLI')
-    parser.add_argument('command', choices=['upload', 'download', 'list', 'delete', 'bulk-upload'])
+    parser.add_argument('command', choices=['upload', 'download', 'list', 'delete', 'bulk-upload', 'sweep', 'scrub'])
     parser.add_argument('--file', '-f', help='File path for upload/download')
-    parser.add_argument('--id', type=int, help='File ID for download/delete')
+    parser.add_argument('--id', type=int, nargs='+', help='File ID(s) for download/delete/scrub')
+    parser.add_argument('--search', help='Delete every file whose name contains this text')
+    parser.add_argument('--yes', '-y', action='store_true', help="Don't ask before a filtered delete")
     parser.add_argument('--dir', '-d', help='Directory for bulk upload')
     parser.add_argument('--output', '-o', default='.', help='Output directory for download')
     parser.add_argument('--extensions', '-e', default='.mp4,.mov,.avi,.mkv,.wmv,.m4v', 
                        help='File extensions for bulk upload (comma-separated)')
+    parser.add_argument('--no-quick-dedup', action='store_true',
+                       help='Skip the duplicate check (size + sampled blocks, confirmed by a full hash) before uploading')
+    parser.add_argument('--no-pack', action='store_true',
+                       help='Bulk upload: send small files as messages of their own instead of packing them together')
+    parser.add_argument('--jobs', '-j', type=int, default=3, help='Files uploaded at once in bulk upload')
+    parser.add_argument('--limit', type=float, help='Total bandwidth cap in MB/s')
+    parser.add_argument('--chunk-size', type=int, help='Size in MB new uploads are split into (default 256, max 1900)')
+    parser.add_argument('--compression', choices=['auto', 'zstd', 'zlib', 'off'],
+                       help='Codec for chunks that compress well (default auto: zstd if available, else zlib)')
+    parser.add_argument('--max-age', type=float, default=24, help='Hours before an unfinished upload is swept')
+    parser.add_argument('--deep', action='store_true', help='Scrub: also download every chunk and check its checksum')
+    parser.add_argument('--manifest', help=f'Bulk upload manifest (default: <dir>/{MANIFEST_NAME})')
+    parser.add_argument('--stats', action='store_true', help='Print where the time went (per phase, retries, FloodWaits) when done')
     args = parser.parse_args()
     
     storage = TelegramStorage(
         api_id=os.environ.get('TG_API_ID'),
         api_hash=os.environ.get('TG_API_HASH'),
-        channel_id=os.environ.get('TG_CHANNEL_ID')
+        channel_id=os.environ.get('TG_CHANNEL_ID'),
+        # Single uploads and downloads also move several chunks at once, so they get connections too
+        pool_size=args.jobs if args.command in ('bulk-upload', 'upload', 'download') else 1,
+        bandwidth_limit=args.limit * 1024 * 1024 if args.limit else None,
+        chunk_size=args.chunk_size * 1024 * 1024 if args.chunk_size else None,
+        compression=args.compression
     )
     
     await storage.start()
@@ -46,53 +192,68 @@ async def main():
             if not args.file:
                 print("Error: --file required")
                 return
-            await storage.upload(args.file)
+            await storage.upload(args.file, progress_callback=Progress(on_update=show_progress), quick_dedup=not args.no_quick_dedup)
         
         elif args.command == 'download':
             if not args.id:
                 print("Error: --id required")
                 return
-            await storage.download(args.id, args.output)
+            for file_id in args.id:
+                await storage.download(file_id, args.output, progress_callback=Progress(on_update=show_progress))
         
         elif args.command == 'delete':
-            if not args.id:
-                print("Error: --id required")
+            if args.search:
+                ids = storage.find_files(args.search)
+                if not ids:
+                    print(f"No files match '{args.search}'")
+                    return
+                if not args.yes and input(f"Delete {len(ids)} file{'' if len(ids) == 1 else 's'} matching '{args.search}'? [y/N] ").lower() != 'y':
+                    return
+            elif args.id:
+                ids = args.id
+            else:
+                print("Error: --id or --search required")
                 return
-            await storage.delete(args.id)
+            deleted = storage.delete_files(ids)
+            print(f"Deleted {deleted} file{'' if deleted == 1 else 's'}, removing chunks from Telegram...")
+            removed = await storage.drain_deletes()
+            print(f"Removed {removed} chunk message{'' if removed == 1 else 's'}")
         
         elif args.command == 'bulk-upload':
             if not args.dir:
                 print("Error: --dir required")
                 return
             
-            extensions = tuple(args.extensions.split(','))
             dir_path = Path(args.dir)
-            
-            # Find all video files
-            videos = []
-            for ext in extensions:
-                videos.extend(dir_path.rglob(f'*{ext}'))
-                videos.extend(dir_path.rglob(f'*{ext.upper()}'))
-            
-            videos = sorted(set(videos))
-            total_size = sum(v.stat().st_size for v in videos)
-            
-            print(f"\n📁 Found {len(videos)} videos ({total_size / (1024**3):.2f} GB)")
-            print("-" * 50)
-            
-            for i, video in enumerate(videos, 1):
-                size = video.stat().st_size / (1024**3)
-                print(f"\n[{i}/{len(videos)}] {video.name} ({size:.2f} GB)")
-                try:
-                    await storage.upload(str(video))
-                except Exception as e:
-                    print(f"❌ Error: {e}")
-                    continue
-            
-            print(f"\n✅ Bulk upload complete!")
+            await bulk_upload(storage, dir_path, args.extensions.split(','), args.jobs,
+                              args.manifest or dir_path / MANIFEST_NAME, quick_dedup=not args.no_quick_dedup, pack=not args.no_pack)
+    
+        elif args.command == 'sweep':
+            swept = await storage.sweep_pending(args.max_age)
+            print(f"Discarded {swept} unfinished upload{'' if swept == 1 else 's'}")
+            removed = await storage.drain_deletes()
+            print(f"Removed {removed} queued chunk message{'' if removed == 1 else 's'}")
+    
+        elif args.command == 'scrub':
+            report = await storage.scrub(args.id, deep=args.deep)
+            print(f"\nChecked {report['chunks']} chunks of {report['files']} files ({report['bytes'] / (1024**3):.2f} GB)")
+            if not report['problems']:
+                print("✅ Everything is intact")
+                return
+            damaged = {}
+            for file_id, filename, idx, what in report['problems']:
+                damaged.setdefault((file_id, filename), []).append(f"chunk {idx}: {what}")
+            print(f"⚠️ {len(damaged)} damaged file{'' if len(damaged) == 1 else 's'}:")
+            for (file_id, filename), issues in damaged.items():
+                print(f"  {file_id:<6} {filename}")
+                for issue in issues:
+                    print(f"         {issue}")
+            sys.exit(1)
     
     finally:
         await storage.stop()
+        if args.stats:
+            print(f"\n{metrics.summary()}")
 
 if __name__ == '__main__':
     asyncio.run(main())
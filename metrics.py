@@ -0,0 +1,260 @@
+"""
+Metrics
+Counters, gauges and histograms for transfers, Telegram and the database, rendered in the Prometheus text format.
+Gunicorn workers each write a snapshot to a shared directory so /metrics can report the whole server.
+"""
+import os
+import json
+import time
+import fcntl
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+# Transfers take from milliseconds (a listing query) to an hour (a 1.9GB chunk on a slow link)
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+SHARE_INTERVAL = 5  # seconds between a worker's snapshots
+RETIRED = 'retired.json'  # counts of workers that have exited, folded together
+
+REGISTRY = []
+
+def _key(labels):
+    return json.dumps(sorted(labels.items()))
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def snapshot(self):
+        with self.lock:
+            return {'type': self.kind, 'help': self.help, 'values': json.loads(json.dumps(self.values))}
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = _key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = _key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        """Count the block as in flight while it runs"""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=SECONDS_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = _key(labels)
+        with self.lock:
+            entry = self.values.setdefault(key, {'buckets': [0] * len(self.buckets), 'sum': 0, 'count': 0})
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry['buckets'][i] += 1
+            entry['sum'] += value
+            entry['count'] += 1
+
+    def snapshot(self):
+        snap = super().snapshot()
+        snap['bounds'] = list(self.buckets)
+        return snap
+
+    @contextmanager
+    def time(self, **labels):
+        began = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - began, **labels)
+
+PHASE_SECONDS = Histogram('tgcloud_phase_seconds', 'Time spent per transfer phase')
+TRANSFER_BYTES = Counter('tgcloud_transfer_bytes_total', 'Bytes moved, by direction')
+COMPRESSION_BYTES = Counter('tgcloud_compression_bytes_total', 'Original and stored size of chunks sent compressed, by codec')
+FLOOD_WAITS = Counter('tgcloud_flood_waits_total', 'FloodWait errors from Telegram, by operation')
+FLOOD_WAIT_SECONDS = Counter('tgcloud_flood_wait_seconds_total', 'Seconds Telegram asked us to wait, by operation')
+RETRIES = Counter('tgcloud_retries_total', 'Telegram requests retried, by reason')
+IN_FLIGHT = Gauge('tgcloud_transfers_in_flight', 'Transfers currently running, by kind')
+DB_SECONDS = Histogram('tgcloud_db_query_seconds', 'Database statement latency, including waiting for a connection')
+
+def snapshot():
+    return {m.name: m.snapshot() for m in REGISTRY}
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _directory():
+    return Path(os.environ.get('TG_METRICS_DIR', '/tmp/tg_metrics'))
+
+def dump(directory=None):
+    """Write this process's snapshot where other workers' /metrics can read it"""
+    directory = Path(directory or _directory())
+    directory.mkdir(parents=True, exist_ok=True)
+    tmp = directory / f".{os.getpid()}.tmp"
+    tmp.write_text(json.dumps(snapshot()))
+    os.replace(tmp, directory / f"{os.getpid()}.json")
+
+def _retire(directory=None):
+    """Fold the snapshots of exited workers into one file, so their counts live on without a file per dead PID.
+
+    A snapshot under this process's own PID was left by an earlier process that had it, and is folded too,
+    so this only runs before the first dump.
+    """
+    directory = Path(directory or _directory())
+    directory.mkdir(parents=True, exist_ok=True)
+    with open(directory / '.retire.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        dead = [path for path in directory.glob('*.json')
+                if path.stem.isdigit() and (int(path.stem) == os.getpid() or not _alive(int(path.stem)))]
+        if not dead:
+            return
+        snaps = []
+        for path in [directory / RETIRED, *dead]:
+            try:
+                snap = json.loads(path.read_text())
+            except (OSError, ValueError):
+                continue
+            snaps.append({name: m for name, m in snap.items() if m['type'] != 'gauge'})
+        tmp = directory / '.retired.tmp'
+        tmp.write_text(json.dumps(_merge(snaps)))
+        os.replace(tmp, directory / RETIRED)
+        for path in dead:
+            path.unlink(missing_ok=True)
+
+def share(directory=None, interval=SHARE_INTERVAL):
+    """Keep dumping this process's snapshot in the background, after retiring what exited workers left behind"""
+    try:
+        _retire(directory)
+    except OSError as e:
+        print(f"Retiring old metrics failed: {e}")
+    
+    def run():
+        while True:
+            try:
+                dump(directory)
+            except OSError as e:
+                print(f"Writing metrics failed: {e}")
+            time.sleep(interval)
+    threading.Thread(target=run, daemon=True).start()
+
+def collect(directory=None):
+    """This process's metrics merged with every other worker's last snapshot.
+
+    Counters and histograms of workers that have exited still count; their gauges don't.
+    """
+    directory = Path(directory or _directory())
+    snaps = [snapshot()]
+    if directory.exists():
+        for path in directory.glob('*.json'):
+            # The retired file has no PID and holds no gauges
+            pid = int(path.stem) if path.stem.isdigit() else None
+            if pid == os.getpid():
+                continue
+            try:
+                snap = json.loads(path.read_text())
+            except (OSError, ValueError):
+                continue
+            if pid and not _alive(pid):
+                snap = {name: m for name, m in snap.items() if m['type'] != 'gauge'}
+            snaps.append(snap)
+    return _merge(snaps)
+
+def _merge(snaps):
+    merged = {}
+    for snap in snaps:
+        for name, m in snap.items():
+            into = merged.setdefault(name, {'type': m['type'], 'help': m['help'], 'bounds': m.get('bounds'), 'values': {}})
+            for key, value in m['values'].items():
+                if m['type'] == 'histogram':
+                    entry = into['values'].setdefault(key, {'buckets': [0] * len(value['buckets']), 'sum': 0, 'count': 0})
+                    entry['buckets'] = [a + b for a, b in zip(entry['buckets'], value['buckets'])]
+                    entry['sum'] += value['sum']
+                    entry['count'] += value['count']
+                else:
+                    into['values'][key] = into['values'].get(key, 0) + value
+    return merged
+
+def _labels(key, extra=()):
+    pairs = [*json.loads(key), *extra]
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+def render(merged):
+    """Prometheus text exposition format"""
+    lines = []
+    for name, m in merged.items():
+        lines.append(f"# HELP {name} {m['help']}")
+        lines.append(f"# TYPE {name} {m['type']}")
+        for key, value in sorted(m['values'].items()):
+            if m['type'] == 'histogram':
+                for bound, count in zip(m['bounds'], value['buckets']):
+                    lines.append(f"{name}_bucket{_labels(key, [('le', bound)])} {count}")
+                lines.append(f"{name}_bucket{_labels(key, [('le', '+Inf')])} {value['count']}")
+                lines.append(f"{name}_sum{_labels(key)} {value['sum']}")
+                lines.append(f"{name}_count{_labels(key)} {value['count']}")
+            else:
+                lines.append(f"{name}{_labels(key)} {value}")
+    return '\n'.join(lines) + '\n'
+
+def summary(merged=None):
+    """Human-readable breakdown of where the time went, for the CLI"""
+    merged = merged or snapshot()
+    lines = []
+
+    def label_text(key):
+        return ', '.join(f"{k}={v}" for k, v in json.loads(key)) or 'all'
+
+    phases = merged['tgcloud_phase_seconds']['values']
+    if phases:
+        lines.append(f"{'Phase':<24} {'Count':>7} {'Total':>10} {'Average':>10}")
+        for key, v in sorted(phases.items(), key=lambda kv: -kv[1]['sum']):
+            lines.append(f"{label_text(key):<24} {v['count']:>7} {v['sum']:>9.1f}s {v['sum'] / v['count']:>9.2f}s")
+    for key, n in sorted(merged['tgcloud_transfer_bytes_total']['values'].items()):
+        lines.append(f"Bytes {label_text(key)}: {n / 1024 / 1024:.1f} MB")
+    compressed = merged['tgcloud_compression_bytes_total']['values']
+    for codec in sorted({dict(json.loads(key))['codec'] for key in compressed}):
+        sides = {dict(json.loads(key))['side']: n for key, n in compressed.items() if dict(json.loads(key))['codec'] == codec}
+        lines.append(f"Compressed with {codec}: {sides.get('original', 0) / 1024 / 1024:.1f} MB sent as {sides.get('stored', 0) / 1024 / 1024:.1f} MB")
+    for name, title in (('tgcloud_flood_waits_total', 'FloodWaits'), ('tgcloud_flood_wait_seconds_total', 'FloodWait seconds'),
+                        ('tgcloud_retries_total', 'Retries')):
+        for key, n in sorted(merged[name]['values'].items()):
+            lines.append(f"{title} ({label_text(key)}): {n:g}")
+    queries = merged['tgcloud_db_query_seconds']['values']
+    if queries:
+        count = sum(v['count'] for v in queries.values())
+        total = sum(v['sum'] for v in queries.values())
+        lines.append(f"Database: {count} statements, {total:.2f}s total, {total / count * 1000:.1f}ms average")
+    return '\n'.join(lines) or 'No transfers recorded'
@@ -4,160 +4,1459 @@ Splits large files into <2GB chunks, uploads to Telegram, reassembles on downloa
 Supports SQLite (local) or Postgres (Railway/production).
 """
 import os
+import io
+import json
 import hashlib
+import zlib
+import time
 import asyncio
+import threading
+import itertools
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
 from pathlib import Path
 from telethon import TelegramClient
+from telethon.errors import FloodWaitError, FileReferenceExpiredError
 from telethon.sessions import StringSession
-from telethon.tl.types import DocumentAttributeFilename
+from telethon.tl.types import DocumentAttributeFilename, InputDocumentFileLocation
+from chunk_cache import ChunkCache
+from metrics import PHASE_SECONDS, TRANSFER_BYTES, COMPRESSION_BYTES, FLOOD_WAITS, FLOOD_WAIT_SECONDS, RETRIES, IN_FLIGHT, DB_SECONDS
 
-CHUNK_SIZE = 1900 * 1024 * 1024  # 1.9GB to stay under 2GB limit
+MAX_CHUNK_SIZE = 1900 * 1024 * 1024  # 1.9GB to stay under 2GB limit
+CHUNK_SIZE = 256 * 1024 * 1024  # default stripe: small enough to send in parallel and retry cheaply
+POOL_HEALTH_INTERVAL = 60  # seconds between pings of idle connections
+REQUEST_SIZE = 512 * 1024  # largest GetFile request Telegram allows
+PART_SPAN = 64 * 1024 * 1024  # documents are fetched as parallel ranges of this size
+STREAM_WINDOW = 4 * 1024 * 1024  # streamed downloads are fetched in windows of this size
+STREAM_PREFETCH = 4  # windows fetched ahead of the reader
+MAX_RETRIES = 5
+SAMPLE_BLOCKS = 64  # blocks read for the quick duplicate check
+SAMPLE_BLOCK_SIZE = 64 * 1024
+FOLLOW_POLL = 0.2  # seconds between checks on a chunk another request is fetching
+JOB_STALE_SECONDS = 600  # a running job this quiet is assumed to have died with its worker
+DEFAULT_REQUEST_RATE = 1024 * 1024  # assumed bytes/s per request for an account not measured yet
+DELETE_BATCH = 100  # most message ids delete_messages takes per request
+DELETE_ATTEMPTS = 10  # queued deletions failing this often are left for inspection
+SCRUB_BATCH = 100  # chunks checked per get_messages request
+SCRUB_PAUSE = 1.0  # seconds between scrub batches, to stay well clear of FloodWaits
+CDC_MARKER = b'\xfe\x8b'  # a content-defined cut may only follow these bytes; 0xfe never occurs in UTF-8 text
+CDC_WINDOW = 64  # bytes before a candidate cut whose CRC decides whether it is one
+SCAN_BLOCK = 8 * 1024 * 1024  # bytes read at a time when scanning a file for chunk boundaries
+FINGERPRINT_PIECE = 4 * 1024 * 1024  # chunk fingerprints hash pieces of this size, so browsers can compute them too
+CODECS = ('zstd', 'zlib')  # chunk compression, by preference
+COMPRESS_SAMPLES = 4  # blocks of a chunk compressed to judge whether the whole is worth it
+COMPRESS_SAMPLE_SIZE = 64 * 1024
+COMPRESS_RATIO = 0.9  # a chunk is sent compressed only if that saves at least a tenth
+COMPRESS_BLOCK = 1024 * 1024  # bytes handed to the compressor at a time
+ZLIB_LEVEL = 1  # compression runs while the chunk is sent, so the fast levels
+ZSTD_LEVEL = 3
+PACK_THRESHOLD = 4 * 1024 * 1024  # files smaller than this are packed together by bulk uploads
+PACK_SIZE = 32 * 1024 * 1024  # most a pack message holds; packs are built in memory
 
-class TelegramStorage:
-    def __init__(self, api_id=None, api_hash=None, channel_id=None, session_name="tg_cloud", database_url=None):
-        self.api_id = int(api_id or os.environ.get('TG_API_ID'))
-        self.api_hash = api_hash or os.environ.get('TG_API_HASH')
-        self.channel_id = int(channel_id or os.environ.get('TG_CHANNEL_ID'))
-        self.database_url = database_url or os.environ.get('DATABASE_URL')
-        
-        # Use string session if provided (for Railway), otherwise file session
-        session_string = os.environ.get('TG_SESSION')
-        if session_string:
-            self.client = TelegramClient(StringSession(session_string), self.api_id, self.api_hash)
-        else:
-            self.client = TelegramClient(session_name, self.api_id, self.api_hash)
-        
-        self._init_db()
-    
-    def _init_db(self):
-        if self.database_url:
-            import psycopg2
-            self.db = psycopg2.connect(self.database_url)
-            self.db.autocommit = True
-            self._pg = True
-            cur = self.db.cursor()
-            cur.execute("""CREATE TABLE IF NOT EXISTS files (
+class ChecksumError(IOError):
+    """Bytes read back don't match the checksum recorded at upload"""
+
+class Account:
+    """One Telegram login: its connections, plus the throughput and FloodWait cooldown the scheduler weighs"""
+    def __init__(self, clients):
+        self.clients = clients
+        self.name = None  # Telegram user id, filled in once connected
+        self.busy = 0
+        self.rate = DEFAULT_REQUEST_RATE  # moving average of bytes/s one request gets through this account
+        self.cooldown_until = 0
+    
+    def cooling(self, now=None):
+        return max(0, self.cooldown_until - (now or time.monotonic()))
+
+class ClientPool:
+    """Long-lived Telegram connections shared by every request in a process.
+
+    Holds `size` connections per account. Requests go to the account expected to serve them soonest,
+    judged by its measured per-request throughput and load, skipping accounts cooling down after a
+    FloodWait. Clients that drop are reconnected when acquired or by the background health check.
+    """
+    def __init__(self, primaries, make_client, size=1, health_interval=POOL_HEALTH_INTERVAL):
+        self.primaries = primaries
+        self.make_client = make_client
+        self.size = max(1, size)
+        self.health_interval = health_interval
+        self.accounts = []
+        self.account_of = {}
+        self.busy = {}
+        self._locks = {}
+        self._health_task = None
+    
+    @property
+    def clients(self):
+        return list(self.account_of)
+    
+    async def start(self):
+        for primary in self.primaries:
+            await self._connect(primary)
+            clients = [primary]
+            for _ in range(self.size - 1):
+                # A file session can't be opened by two clients at once, so extra connections reuse its auth key
+                client = self.make_client(StringSession(StringSession.save(primary.session)))
+                await self._connect(client)
+                clients.append(client)
+            account = Account(clients)
+            account.name = str((await primary.get_me()).id)
+            self.accounts.append(account)
+            for client in clients:
+                self.account_of[client] = account
+        self.busy = {c: 0 for c in self.account_of}
+        self._locks = {c: asyncio.Lock() for c in self.account_of}
+        self._health_task = asyncio.ensure_future(self._health_loop())
+    
+    async def stop(self):
+        if self._health_task:
+            self._health_task.cancel()
+            self._health_task = None
+        for client in self.account_of:
+            await client.disconnect()
+        self.accounts = []
+        self.account_of = {}
+    
+    async def _connect(self, client):
+        await client.connect()
+        if not await client.is_user_authorized():
+            raise Exception("Telegram session invalid - regenerate TG_SESSION")
+    
+    async def _ensure(self, client, force=False):
+        async with self._locks[client]:
+            if force and client.is_connected():
+                await client.disconnect()
+            if not client.is_connected():
+                print("Reconnecting to Telegram...")
+                await self._connect(client)
+    
+    def _pick(self, account=None):
+        # Pinned requests (file references recorded by one account) stay on it if it is still configured
+        candidates = [a for a in self.accounts if a.name == account] or self.accounts
+        now = time.monotonic()
+        ready = [a for a in candidates if not a.cooling(now)]
+        if not ready:
+            return min(candidates, key=lambda a: a.cooldown_until)
+        return min(ready, key=lambda a: (a.busy + 1) / a.rate)
+    
+    @asynccontextmanager
+    async def acquire(self, account=None):
+        """A client, preferably of the named account; waits out a cooldown only when every candidate is cooling"""
+        chosen = self._pick(account)
+        client = min(chosen.clients, key=self.busy.get)
+        self.busy[client] += 1
+        chosen.busy += 1
+        try:
+            if chosen.cooling():
+                await asyncio.sleep(chosen.cooling())
+            await self._ensure(client)
+            yield client
+        finally:
+            self.busy[client] -= 1
+            chosen.busy -= 1
+    
+    def account_name(self, client):
+        return self.account_of[client].name
+    
+    def record(self, client, nbytes, seconds):
+        """Feed a finished transfer into its account's throughput estimate"""
+        if nbytes and seconds > 0.05:
+            account = self.account_of[client]
+            account.rate = 0.7 * account.rate + 0.3 * (nbytes / seconds)
+    
+    def cooldown(self, client, seconds):
+        """Keep new requests off a client's account until Telegram's FloodWait has passed"""
+        if client in self.account_of:
+            account = self.account_of[client]
+            account.cooldown_until = max(account.cooldown_until, time.monotonic() + seconds + 1)
+    
+    def stats(self):
+        return [{'account': a.name, 'connections': len(a.clients), 'busy': a.busy, 'rate': a.rate, 'cooldown': a.cooling()}
+                for a in self.accounts]
+    
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            for client in self.clients:
+                if self.busy[client]:
+                    continue  # in-flight requests already prove it's alive
+                try:
+                    await self._ensure(client)
+                    await asyncio.wait_for(client.get_me(input_peer=True), 30)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print(f"Telegram health check failed: {e}")
+                    try:
+                        await self._ensure(client, force=True)
+                    except Exception as e:
+                        print(f"Reconnect failed: {e}")
+
+class RateLimiter:
+    """Token bucket shared by every transfer of a storage: at most `rate` bytes per second"""
+    def __init__(self, rate):
+        self.rate = rate
+        self.allowance = rate
+        self.last = time.monotonic()
+        self.lock = asyncio.Lock()
+    
+    async def consume(self, nbytes):
+        async with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate)
+            self.last = now
+            self.allowance -= nbytes
+            if self.allowance < 0:
+                # Holding the lock while waiting keeps the total rate fair across transfers
+                await asyncio.sleep(-self.allowance / self.rate)
+
+class Progress:
+    """Bytes, smoothed rate and ETA of one transfer; usable directly as a Telethon progress_callback.
+
+    on_update is called at most once a second (and on completion) so it can
+    afford to write to the database or the terminal.
+    """
+    def __init__(self, total=0, on_update=None):
+        self.total = total
+        self.done = 0
+        self.rate = 0.0
+        self.on_update = on_update
+        self._last = time.monotonic()
+        self._last_done = 0
+    
+    def __call__(self, done, total=None):
+        if total:
+            self.total = total
+        self.done = done
+        now = time.monotonic()
+        elapsed = now - self._last
+        if elapsed >= 1 or done >= self.total:
+            current = (done - self._last_done) / elapsed if elapsed > 0 else 0
+            self.rate = current if not self.rate else 0.7 * self.rate + 0.3 * current
+            self._last, self._last_done = now, done
+            if self.on_update:
+                self.on_update(self)
+    
+    @property
+    def eta(self):
+        return (self.total - self.done) / self.rate if self.rate else None
+    
+    def describe(self):
+        eta = f" • ~{self.eta / 60:.1f} min left" if self.eta else ""
+        return f"{self.done / 1024 / 1024:.1f} / {self.total / 1024 / 1024:.1f} MB • {self.rate / 1024 / 1024:.2f} MB/s{eta}"
+
+class FileWindow:
+    """Read-only file object over `length` bytes of a file starting at `offset`.
+
+    Telethon reads it part by part, so a chunk uploads straight from the
+    source file without a temp copy or holding the chunk in memory.
+    """
+    def __init__(self, path, offset, length, name=None, hashers=()):
+        self.f = open(path, 'rb')
+        self.offset = offset
+        self.length = length
+        self.pos = 0
+        self.name = name or Path(path).name
+        self.hashers = hashers
+        self.hashed = 0
+    
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.length - self.pos:
+            size = self.length - self.pos
+        self.f.seek(self.offset + self.pos)
+        data = self.f.read(size)
+        start = self.pos
+        self.pos += len(data)
+        # Hash as the bytes go out; re-reads after a seek back aren't counted twice
+        if start <= self.hashed < self.pos:
+            fresh = data[self.hashed - start:]
+            for h in self.hashers:
+                h.update(fresh)
+            self.hashed = self.pos
+        return data
+    
+    def seek(self, pos, whence=os.SEEK_SET):
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self.pos, os.SEEK_END: self.length}[whence]
+        self.pos = min(max(0, base + pos), self.length)
+        return self.pos
+    
+    def tell(self):
+        return self.pos
+    
+    def seekable(self):
+        return True
+    
+    def close(self):
+        self.f.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+class UploadPipe:
+    """File object Telethon can send while its bytes are still arriving from another thread.
+
+    The receiving thread write()s as data comes in; everything is spooled to `path`
+    too, so a resend after a FloodWait starts over from the spool instead of the network.
+    """
+    def __init__(self, path, length, loop, name=None):
+        self.path = Path(path)
+        self.out = open(self.path, 'wb', buffering=0)
+        self.f = open(self.path, 'rb')
+        self.length = length
+        self.loop = loop
+        self.name = name or self.path.name
+        self.pos = 0
+        self.received = 0
+        self.hash = hashlib.md5()
+        self.fingerprint = Fingerprint()
+        self.error = None
+        self.closed = False
+        self._lock = threading.Lock()
+        self._arrived = asyncio.Event()
+
+    def write(self, data):
+        """Called by the receiving thread; raises BrokenPipeError once the sender has given up"""
+        with self._lock:
+            if self.closed:
+                raise BrokenPipeError("Upload to Telegram already stopped")
+            if self.received + len(data) > self.length:
+                raise ValueError(f"Chunk is larger than the {self.length} bytes announced")
+            self.out.write(data)
+            self.hash.update(data)
+            self.fingerprint.update(data)
+            self.received += len(data)
+        self.loop.call_soon_threadsafe(self._arrived.set)
+
+    def finish(self):
+        if self.received != self.length:
+            raise EOFError(f"Chunk ended after {self.received} of {self.length} bytes")
+
+    def fail(self, error):
+        """The incoming data broke off; the sender's pending read raises `error`"""
+        self.error = error
+        self.loop.call_soon_threadsafe(self._arrived.set)
+
+    async def read(self, size=-1):
+        if size is None or size < 0 or size > self.length - self.pos:
+            size = self.length - self.pos
+        while self.received < self.pos + size:
+            if self.error:
+                raise self.error
+            self._arrived.clear()
+            if self.received < self.pos + size and not self.error:
+                await self._arrived.wait()
+        data = os.pread(self.f.fileno(), size, self.pos)
+        self.pos += len(data)
+        return data
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self.pos, os.SEEK_END: self.length}[whence]
+        self.pos = min(max(0, base + pos), self.length)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def seekable(self):
+        return True
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+    def close(self):
+        """Stop accepting data and delete the spool"""
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.out.close()
+            self.f.close()
+            self.path.unlink(missing_ok=True)
+
+class ChunkVerifier:
+    """Checks one chunk against the MD5 recorded at upload while its bytes arrive.
+
+    In-order data is hashed as passed to update(). Ranges fetched out of order are
+    reported with written(); once the gap before them fills they are read back with
+    read_at(offset, length) while still in the page cache, so no separate pass is needed.
+    Chunks without a recorded hash (uploaded before hashes existed) always pass.
+    """
+    def __init__(self, expected, size, read_at=None, name="chunk"):
+        self.expected = expected
+        self.size = size
+        self.read_at = read_at
+        self.name = name
+        self.hash = hashlib.md5()
+        self.pos = 0
+        self.pieces = {}
+    
+    def update(self, data):
+        self.hash.update(data)
+        self.pos += len(data)
+    
+    def written(self, offset, length):
+        self.pieces[offset] = offset + length
+        while self.pos in self.pieces:
+            end = self.pieces.pop(self.pos)
+            for start in range(self.pos, end, STREAM_WINDOW):
+                self.update(self.read_at(start, min(STREAM_WINDOW, end - start)))
+    
+    def hexdigest(self):
+        return self.hash.hexdigest()
+    
+    def check(self):
+        if self.pos != self.size:
+            raise ChecksumError(f"{self.name} ended after {self.pos} of {self.size} bytes")
+        if self.expected and self.hexdigest() != self.expected:
+            raise ChecksumError(f"{self.name} doesn't match its checksum ({self.hexdigest()} != {self.expected})")
+    
+    @staticmethod
+    def combine(chunk_hashes):
+        """Whole-file checksum: MD5 of the chunk MD5s in order plus the chunk count, like S3 multipart ETags"""
+        if any(h is None for h in chunk_hashes):
+            return None
+        return hashlib.md5(b''.join(bytes.fromhex(h) for h in chunk_hashes)).hexdigest() + f"-{len(chunk_hashes)}"
+
+class Fingerprint:
+    """SHA-256 over the SHA-256s of a chunk's FINGERPRINT_PIECE pieces: the key chunks are deduplicated on.
+
+    Built from pieces because browsers can only hash a buffer at once, and a whole chunk is too big for one.
+    """
+    def __init__(self):
+        self.digests = []
+        self.piece = hashlib.sha256()
+        self.filled = 0
+    
+    def update(self, data):
+        data = memoryview(data)
+        while data:
+            take = min(len(data), FINGERPRINT_PIECE - self.filled)
+            self.piece.update(data[:take])
+            self.filled += take
+            data = data[take:]
+            if self.filled == FINGERPRINT_PIECE:
+                self.digests.append(self.piece.digest())
+                self.piece = hashlib.sha256()
+                self.filled = 0
+    
+    def hexdigest(self):
+        digests = self.digests + ([self.piece.digest()] if self.filled else [])
+        return hashlib.sha256(b''.join(digests)).hexdigest()
+
+class Chunker:
+    """Content-defined chunk boundaries, so an edit near the start of a file only changes the chunks around it.
+
+    A cut may follow any CDC_MARKER between min_size and max_size into the chunk; it is taken when the CRC-32
+    of the CDC_WINDOW bytes ending there is a multiple of `modulus`, which puts the average near chunk_size.
+    After `patience` rejected candidates the next one is taken regardless, so repetitive data can't stall it.
+    The page script cuts files the same way; params() is what it is given.
+    """
+    def __init__(self, chunk_size):
+        self.min_size = chunk_size // 2
+        self.max_size = min(chunk_size * 2, MAX_CHUNK_SIZE)
+        # Random bytes hold a marker every 64KB, so this many candidates span the other half of chunk_size
+        self.modulus = max(1, (chunk_size - self.min_size) // 65536)
+        self.patience = 4 * self.modulus
+        self.start = 0
+        self.offset = 0
+        self.rejected = 0
+        self.tail = b''
+    
+    def params(self):
+        return {'min': self.min_size, 'max': self.max_size, 'modulus': self.modulus, 'patience': self.patience,
+                'window': CDC_WINDOW, 'marker': list(CDC_MARKER), 'piece': FINGERPRINT_PIECE}
+    
+    def feed(self, data):
+        """Offsets where chunks end within the next `data` of the file"""
+        view = self.tail + data
+        base = self.offset - len(self.tail)
+        end = self.offset + len(data)
+        checked = self.offset  # cuts up to here were considered by earlier calls
+        cuts = []
+        while True:
+            lowest = max(self.start + self.min_size, checked + 1)
+            highest = min(self.start + self.max_size, end)
+            cut = None
+            i = view.find(CDC_MARKER, max(0, lowest - len(CDC_MARKER) - base))
+            while i != -1 and base + i + len(CDC_MARKER) <= highest:
+                at = i + len(CDC_MARKER)
+                if self.rejected >= self.patience or zlib.crc32(view[at - CDC_WINDOW:at]) % self.modulus == 0:
+                    cut = base + at
+                    break
+                self.rejected += 1
+                i = view.find(CDC_MARKER, i + 1)
+            if cut is None and self.start + self.max_size <= end:
+                cut = self.start + self.max_size
+            if cut is None:
+                break
+            cuts.append(cut)
+            self.start = checked = cut
+            self.rejected = 0
+        self.tail = view[-CDC_WINDOW:]
+        self.offset = end
+        return cuts
+    
+    def finish(self):
+        """Offset where the last chunk ends, or None if the file ended on a cut"""
+        return self.offset if self.offset > self.start else None
+
+def scan_chunks(path, chunk_size, on_chunk, stop=None):
+    """Read a file once, calling on_chunk(start, length, fingerprint) for each content-defined chunk as it is found.
+
+    Returns the MD5 of the whole file, or None if `stop` (a threading.Event) was set first.
+    """
+    chunker = Chunker(chunk_size)
+    file_hash = hashlib.md5()
+    fingerprint = Fingerprint()
+    start = offset = 0
+    with open(path, 'rb') as f:
+        while data := f.read(SCAN_BLOCK):
+            if stop and stop.is_set():
+                return None
+            file_hash.update(data)
+            used = 0
+            for cut in chunker.feed(data):
+                fingerprint.update(memoryview(data)[used:cut - offset])
+                on_chunk(start, cut - start, fingerprint.hexdigest())
+                fingerprint = Fingerprint()
+                start, used = cut, cut - offset
+            fingerprint.update(memoryview(data)[used:])
+            offset += len(data)
+    end = chunker.finish()
+    if end is not None:
+        on_chunk(start, end - start, fingerprint.hexdigest())
+    return file_hash.hexdigest()
+
+def _zstd():
+    """The zstd module: in the standard library from Python 3.14, the backports.zstd package before that"""
+    try:
+        from compression import zstd
+    except ImportError:
+        from backports import zstd
+    return zstd
+
+def pick_codec(name):
+    """Codec new chunks may be compressed with: 'auto' is zstd where available and zlib otherwise; 'off' is None"""
+    if name == 'off':
+        return None
+    if name == 'auto':
+        try:
+            _zstd()
+            return 'zstd'
+        except ImportError:
+            return 'zlib'
+    if name not in CODECS:
+        raise ValueError(f"Unknown compression {name!r}, expected auto, off or one of {', '.join(CODECS)}")
+    if name == 'zstd':
+        _zstd()  # a missing module is reported now rather than at the first compressible chunk
+    return name
+
+def compressor(codec):
+    """Object with compress(data) and flush(), like zlib.compressobj()"""
+    if codec == 'zstd':
+        return _zstd().ZstdCompressor(level=ZSTD_LEVEL)
+    return zlib.compressobj(ZLIB_LEVEL)
+
+class Decompressor:
+    """Undoes a chunk's compression as its document arrives.
+
+    Output comes out at most STREAM_WINDOW at a time, so a chunk of zeros can't balloon in memory.
+    """
+    def __init__(self, codec):
+        self.codec = codec
+        self.d = _zstd().ZstdDecompressor() if codec == 'zstd' else zlib.decompressobj()
+    
+    def feed(self, data):
+        """Yield what the next `data` of the document decompresses to"""
+        if self.codec == 'zstd':
+            out = self.d.decompress(data, STREAM_WINDOW)
+            while True:
+                if out:
+                    yield out
+                if self.d.eof or self.d.needs_input:
+                    return
+                out = self.d.decompress(b'', STREAM_WINDOW)
+        while True:
+            out = self.d.decompress(data, STREAM_WINDOW)
+            data = self.d.unconsumed_tail
+            if out:
+                yield out
+            if not data and len(out) < STREAM_WINDOW:
+                return
+
+class CompressedStream:
+    """File object Telethon can send: `source`, read from its start, compressed with `codec` as it is read.
+
+    Telethon needs the size before the first part, so measure() compresses the whole source once and keeps
+    only the count; reads then compress it again. Both passes feed the compressor the same blocks, so they
+    produce the same bytes. Seeking back, as a resend after a FloodWait does, starts the compressor over.
+    """
+    def __init__(self, source, codec):
+        self.source = source
+        self.codec = codec
+        self.name = getattr(source, 'name', None)
+        self.length = None
+        self.pos = 0
+        self._restart()
+    
+    def _restart(self):
+        self.source.seek(0)
+        self.compressor = compressor(self.codec)
+        self.buffer = bytearray()
+        self.emitted = 0  # compressed bytes already dropped from the front of the buffer
+        self.ended = False
+    
+    async def _fill(self, size):
+        while len(self.buffer) < size and not self.ended:
+            data = self.source.read(COMPRESS_BLOCK)
+            if asyncio.iscoroutine(data):
+                data = await data
+            if data:
+                self.buffer += await asyncio.to_thread(self.compressor.compress, data)
+            else:
+                self.buffer += self.compressor.flush()
+                self.ended = True
+    
+    async def measure(self):
+        """Compressed size of the whole source"""
+        total = 0
+        self._restart()
+        while not self.ended:
+            await self._fill(1)
+            total += len(self.buffer)
+            self.buffer.clear()
+        self.length = total
+        self.pos = 0
+        self._restart()
+        return total
+    
+    async def read(self, size=-1):
+        if size is None or size < 0 or size > self.length - self.pos:
+            size = self.length - self.pos
+        start = self.pos - self.emitted
+        await self._fill(start + size)
+        data = bytes(self.buffer[start:start + size])
+        if len(data) < size:
+            raise IOError(f"{self.name} compressed to fewer bytes than measured")
+        del self.buffer[:start + size]
+        self.emitted = self.pos = self.pos + size
+        return data
+    
+    def seek(self, pos, whence=os.SEEK_SET):
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self.pos, os.SEEK_END: self.length}[whence]
+        self.pos = min(max(0, base + pos), self.length)
+        if self.pos < self.emitted:
+            self._restart()
+        return self.pos
+    
+    def tell(self):
+        return self.pos
+    
+    def seekable(self):
+        return True
+
+class ChunkRef:
+    """Where a chunk's document lives, enough to download it without looking up its message first.
+
+    `account` is the one whose file reference this is; downloads go through it when it's still configured.
+    A chunk sent compressed has its `codec` and the `stored_size` of the document Telegram holds.
+    A small file packed with others starts `offset` bytes into the document.
+    """
+    def __init__(self, channel_id, msg_id, doc_id, access_hash, file_reference, dc_id, account=None, codec=None, stored_size=None, offset=0):
+        self.channel_id = channel_id
+        self.msg_id = msg_id
+        self.dc_id = dc_id
+        self.account = account
+        self.codec = codec
+        self.stored_size = stored_size
+        self.offset = offset or 0
+        self.location = InputDocumentFileLocation(id=doc_id, access_hash=access_hash, file_reference=file_reference, thumb_size='')
+        self.refreshing = asyncio.Lock()
+    
+    @property
+    def key(self):
+        return (self.channel_id, self.msg_id)
+    
+    @property
+    def chunk_key(self):
+        """(channel_id, message_id, offset): tells apart the files packed into one message"""
+        return (self.channel_id, self.msg_id, self.offset)
+    
+    @classmethod
+    def from_row(cls, channel_id, msg_id, doc_id, access_hash, file_reference, dc_id, account, codec=None, stored_size=None, offset=0):
+        return cls(channel_id, msg_id, doc_id, access_hash, bytes.fromhex(file_reference), dc_id, account, codec, stored_size, offset)
+    
+    @staticmethod
+    def columns(document):
+        """(doc_id, access_hash, file_reference, dc_id) as stored in the chunk tables"""
+        if document is None:
+            return (None, None, None, None)
+        return (document.id, document.access_hash, document.file_reference.hex(), document.dc_id)
+
+class Database:
+    """Process-wide metadata store: a psycopg2 connection pool, or one WAL-mode SQLite connection per thread"""
+    _open = {}
+    _open_lock = threading.Lock()
+    
+    @classmethod
+    def open(cls, url=None, path="files.db"):
+        """Shared instance per database; the schema is created and migrated only the first time"""
+        key = url or os.path.abspath(path)
+        with cls._open_lock:
+            if key not in cls._open:
+                cls._open[key] = cls(url, path)
+            return cls._open[key]
+    
+    def __init__(self, url=None, path="files.db", pool_size=None):
+        self.url = url
+        self.path = os.path.abspath(path)
+        self.pg = bool(url)
+        self.local = threading.local()
+        if self.pg:
+            from psycopg2.pool import ThreadedConnectionPool
+            pool_size = int(pool_size or os.environ.get('DB_POOL_SIZE', 10))
+            self.pool = ThreadedConnectionPool(1, pool_size, url)
+            # ThreadedConnectionPool raises instead of waiting when it runs dry
+            self.slots = threading.BoundedSemaphore(pool_size)
+        self._init_schema()
+    
+    def _init_schema(self):
+        if self.pg:
+            ddl = [
+                """CREATE TABLE IF NOT EXISTS files (
                 id SERIAL PRIMARY KEY, filename TEXT, original_size BIGINT,
-                hash TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""")
-            cur.execute("""CREATE TABLE IF NOT EXISTS chunks (
+                hash TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""",
+                """CREATE TABLE IF NOT EXISTS chunks (
                 id SERIAL PRIMARY KEY, file_id INTEGER REFERENCES files(id),
-                chunk_index INTEGER, message_id BIGINT, size BIGINT)""")
-            cur.execute("""CREATE TABLE IF NOT EXISTS pending_chunks (
+                chunk_index INTEGER, message_id BIGINT, size BIGINT)""",
+                """CREATE TABLE IF NOT EXISTS pending_chunks (
                 id SERIAL PRIMARY KEY, upload_id TEXT, filename TEXT, total_size BIGINT,
-                total_chunks INTEGER, chunk_index INTEGER, message_id BIGINT, chunk_size BIGINT)""")
+                total_chunks INTEGER, chunk_index INTEGER, message_id BIGINT, chunk_size BIGINT)""",
+            ]
         else:
-            import sqlite3
-            self.db = sqlite3.connect("files.db", check_same_thread=False)
-            self._pg = False
-            self.db.execute("""CREATE TABLE IF NOT EXISTS files (
+            ddl = [
+                """CREATE TABLE IF NOT EXISTS files (
                 id INTEGER PRIMARY KEY, filename TEXT, original_size INTEGER,
-                hash TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""")
-            self.db.execute("""CREATE TABLE IF NOT EXISTS chunks (
+                hash TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""",
+                """CREATE TABLE IF NOT EXISTS chunks (
                 id INTEGER PRIMARY KEY, file_id INTEGER, chunk_index INTEGER,
-                message_id INTEGER, size INTEGER, FOREIGN KEY (file_id) REFERENCES files(id))""")
-            self.db.execute("""CREATE TABLE IF NOT EXISTS pending_chunks (
+                message_id INTEGER, size INTEGER, FOREIGN KEY (file_id) REFERENCES files(id))""",
+                """CREATE TABLE IF NOT EXISTS pending_chunks (
                 id INTEGER PRIMARY KEY, upload_id TEXT, filename TEXT, total_size INTEGER,
-                total_chunks INTEGER, chunk_index INTEGER, message_id INTEGER, chunk_size INTEGER)""")
-            self.db.commit()
+                total_chunks INTEGER, chunk_index INTEGER, message_id INTEGER, chunk_size INTEGER)""",
+            ]
+        ddl.append("""CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY, kind TEXT, status TEXT, result TEXT, error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""")
+        # Chunk messages of deleted files, removed from Telegram in the background
+        if self.pg:
+            ddl.append("""CREATE TABLE IF NOT EXISTS delete_queue (
+                id SERIAL PRIMARY KEY, message_id BIGINT, attempts INTEGER DEFAULT 0, error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""")
+        else:
+            ddl.append("""CREATE TABLE IF NOT EXISTS delete_queue (
+                id INTEGER PRIMARY KEY, message_id INTEGER, attempts INTEGER DEFAULT 0, error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""")
+        # Chunk messages new uploads can point at instead of sending the same bytes again,
+        # with how many chunk rows (finished or pending) point at each
+        if self.pg:
+            ddl.append("""CREATE TABLE IF NOT EXISTS blocks (
+                id SERIAL PRIMARY KEY, fingerprint TEXT, size BIGINT, hash TEXT, channel_id BIGINT, message_id BIGINT,
+                doc_id BIGINT, access_hash BIGINT, file_reference TEXT, dc_id INTEGER, account TEXT, refs INTEGER)""")
+        else:
+            ddl.append("""CREATE TABLE IF NOT EXISTS blocks (
+                id INTEGER PRIMARY KEY, fingerprint TEXT, size INTEGER, hash TEXT, channel_id INTEGER, message_id INTEGER,
+                doc_id INTEGER, access_hash INTEGER, file_reference TEXT, dc_id INTEGER, account TEXT, refs INTEGER)""")
+        # Single row bumped whenever the file list changes, so every worker can validate cached listings
+        ddl.append("CREATE TABLE IF NOT EXISTS library (id INTEGER PRIMARY KEY, version BIGINT)")
+        ddl.append("INSERT INTO library (id, version) SELECT 1, 0 WHERE NOT EXISTS (SELECT 1 FROM library)")
+        with self.transaction():
+            for statement in ddl:
+                self.execute(statement)
+            self._migrate()
+    
+    def _migrate(self):
+        self._add_column("files", "sample_hash", "TEXT")
+        self._add_column("chunks", "hash", "TEXT")
+        self._add_column("pending_chunks", "chunk_hash", "TEXT")
+        self._add_column("pending_chunks", "created_at", "TIMESTAMP")
+        self._add_column("jobs", "bytes_done", "BIGINT")
+        self._add_column("jobs", "bytes_total", "BIGINT")
+        self._add_column("jobs", "rate", "REAL")
+        
+        # Listing reads these instead of aggregating chunks per request
+        self._add_column("files", "chunk_count", "INTEGER")
+        self._add_column("files", "stored_size", "BIGINT")
+        self._add_column("files", "chunk_size", "BIGINT")
+        # Checksum over the chunk hashes; files.hash is the dedup key and isn't always a content hash
+        self._add_column("files", "checksum", "TEXT")
+        self.execute("""UPDATE files SET
+            chunk_count = (SELECT COUNT(*) FROM chunks WHERE chunks.file_id = files.id),
+            stored_size = (SELECT COALESCE(SUM(size), 0) FROM chunks WHERE chunks.file_id = files.id)
+            WHERE chunk_count IS NULL""")
+        
+        # Chunk documents are recorded at upload so downloads can skip the get_messages round trip
+        for table in ("chunks", "pending_chunks"):
+            self._add_column(table, "doc_id", "BIGINT")
+            self._add_column(table, "access_hash", "BIGINT")
+            self._add_column(table, "file_reference", "TEXT")
+            self._add_column(table, "dc_id", "INTEGER")
+            # Rows from before sharding have neither: they are in the primary channel, any account may read them
+            self._add_column(table, "channel_id", "BIGINT")
+            self._add_column(table, "account", "TEXT")
+        self._add_column("delete_queue", "channel_id", "BIGINT")
+        # Chunks sent compressed: their codec and the size of the document on Telegram
+        for table in ("chunks", "pending_chunks", "blocks"):
+            self._add_column(table, "codec", "TEXT")
+            self._add_column(table, "stored_size", "BIGINT")
+        # Small files packed into a shared message start this far into its document
+        self._add_column("chunks", "pack_offset", "BIGINT")
+        # A resumed upload only skips a journaled chunk whose content still matches
+        self._add_column("pending_chunks", "fingerprint", "TEXT")
+        
+        self._add_index("chunks", "file_id", "chunk_index")
+        self._add_index("chunks", "message_id")
+        self._add_index("files", "hash")
+        self._add_index("files", "original_size", "sample_hash")
+        self._add_index("pending_chunks", "upload_id", "chunk_index")
+        self._add_index("jobs", "updated_at")
+        self._add_index("blocks", "fingerprint", "size")
+        self._add_index("blocks", "message_id")
+    
+    def _add_index(self, table, *columns):
+        name = f"idx_{table}_{'_'.join(columns)}"
+        self.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})")
+    
+    def _add_column(self, table, column, decl):
+        if self.pg:
+            self.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {decl}")
+        elif column not in [row[1] for row in self.execute(f"PRAGMA table_info({table})", fetch='all')]:
+            self.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+    
+    def _acquire(self):
+        if self.pg:
+            self.slots.acquire()
+            try:
+                return self.pool.getconn()
+            except Exception:
+                self.slots.release()
+                raise
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            import sqlite3
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+    
+    def _release(self, conn, broken=False):
+        if self.pg:
+            self.pool.putconn(conn, close=broken)
+            self.slots.release()
+    
+    @contextmanager
+    def transaction(self):
+        """Statements this thread runs inside the block commit together or not at all"""
+        if getattr(self.local, 'tx', None) is not None:
+            yield
+            return
+        conn = self._acquire()
+        self.local.tx = conn
+        broken = False
+        try:
+            yield
+            conn.commit()
+        except BaseException:
+            broken = not self._rollback(conn)
+            raise
+        finally:
+            self.local.tx = None
+            self._release(conn, broken)
+    
+    def _rollback(self, conn):
+        try:
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+    
+    def _run(self, work, query):
+        with DB_SECONDS.time(statement=query.split(None, 1)[0].lower()):
+            return self._run_timed(work)
+    
+    def _run_timed(self, work):
+        conn = getattr(self.local, 'tx', None)
+        if conn is not None:
+            return work(conn.cursor())
+        conn = self._acquire()
+        broken = False
+        try:
+            result = work(conn.cursor())
+            conn.commit()
+            return result
+        except BaseException:
+            broken = not self._rollback(conn)
+            raise
+        finally:
+            self._release(conn, broken)
+    
+    def _sql(self, query):
+        return query.replace('?', '%s') if self.pg else query
+    
+    def execute(self, query, params=(), fetch=None):
+        def work(cur):
+            cur.execute(self._sql(query), params)
+            if fetch == 'one': return cur.fetchone()
+            if fetch == 'all': return cur.fetchall()
+            return cur.rowcount
+        return self._run(work, query)
+    
+    def executemany(self, query, rows):
+        def work(cur):
+            cur.executemany(self._sql(query), rows)
+            return cur.rowcount
+        return self._run(work, query)
+    
+    def insert_id(self, query, params=()):
+        def work(cur):
+            if self.pg:
+                cur.execute(self._sql(query) + ' RETURNING id', params)
+                return cur.fetchone()[0]
+            cur.execute(query, params)
+            return cur.lastrowid
+        return self._run(work, query)
+
+class TelegramStorage:
+    def __init__(self, api_id=None, api_hash=None, channel_id=None, session_name="tg_cloud", database_url=None, pool_size=1, download_concurrency=None, bandwidth_limit=None, cache_dir=None, cache_bytes=None, sessions=None, channel_ids=None, chunk_size=None, upload_concurrency=None, compression=None, pack_threshold=None, pack_size=None):
+        self.api_id = int(api_id or os.environ.get('TG_API_ID'))
+        self.api_hash = api_hash or os.environ.get('TG_API_HASH')
+        # New chunks are spread over every channel; rows from before sharding live in the primary one
+        channel_ids = channel_ids or [c for c in os.environ.get('TG_CHANNEL_IDS', '').split(',') if c.strip()]
+        self.channel_id = int(channel_id or os.environ.get('TG_CHANNEL_ID') or channel_ids[0])
+        self.channels = [int(c) for c in channel_ids] or [self.channel_id]
+        self._channel_turn = itertools.count()
+        self.database_url = database_url or os.environ.get('DATABASE_URL')
+        self.download_concurrency = int(download_concurrency or os.environ.get('TG_DOWNLOAD_CONCURRENCY', 8))
+        self.upload_concurrency = int(upload_concurrency or os.environ.get('TG_UPLOAD_CONCURRENCY', 3))
+        # Size new uploads are split into; files keep the size they were stored with
+        self.chunk_size = max(REQUEST_SIZE, min(int(chunk_size or os.environ.get('TG_CHUNK_SIZE', CHUNK_SIZE)), MAX_CHUNK_SIZE))
+        # Chunks that compress well are sent compressed with this codec; None sends everything as it is
+        self.compression = pick_codec(compression or os.environ.get('TG_COMPRESSION', 'auto'))
+        # Bulk uploads pack files under pack_threshold into shared messages of up to pack_size; 0 turns that off
+        self.pack_threshold = int(pack_threshold if pack_threshold is not None else os.environ.get('TG_PACK_THRESHOLD', PACK_THRESHOLD))
+        self.pack_size = min(int(pack_size or os.environ.get('TG_PACK_SIZE', PACK_SIZE)), MAX_CHUNK_SIZE)
+        self.limiter = RateLimiter(bandwidth_limit) if bandwidth_limit else None
+        cache_bytes = int(cache_bytes or os.environ.get('TG_CACHE_BYTES', 0))
+        self.cache = ChunkCache(cache_dir, cache_bytes) if cache_bytes else None
+        
+        # Each account in TG_SESSIONS (comma-separated string sessions) adds bandwidth and its own FloodWait budget;
+        # otherwise one account from TG_SESSION (for Railway) or the local file session
+        sessions = sessions or [s.strip() for s in os.environ.get('TG_SESSIONS', '').split(',') if s.strip()]
+        if not sessions and os.environ.get('TG_SESSION'):
+            sessions = [os.environ['TG_SESSION']]
+        sessions = [StringSession(s) for s in sessions] or [session_name]
+        make_client = lambda session: TelegramClient(session, self.api_id, self.api_hash)
+        self.pool = ClientPool([make_client(s) for s in sessions], make_client, size=pool_size)
+        
+        self.db = Database.open(self.database_url)
+        self._pg = self.db.pg
+        self._draining = asyncio.Lock()
     
     def _q(self, query, params=(), fetch=None):
-        q = query.replace('?', '%s') if self._pg else query
-        if self._pg:
-            cur = self.db.cursor()
-            cur.execute(q, params)
-        else:
-            cur = self.db.execute(q, params)
-            if not fetch: self.db.commit()
-        if fetch == 'one': return cur.fetchone()
-        if fetch == 'all': return cur.fetchall()
-        return cur
+        return self.db.execute(query, params, fetch)
+    
+    def _qmany(self, query, rows):
+        return self.db.executemany(query, rows)
     
     def _insert_id(self, query, params=()):
-        if self._pg:
-            cur = self.db.cursor()
-            cur.execute(query.replace('?', '%s') + ' RETURNING id', params)
-            return cur.fetchone()[0]
-        cur = self.db.execute(query, params)
-        self.db.commit()
-        return cur.lastrowid
+        return self.db.insert_id(query, params)
     
     async def start(self):
-        await self.client.connect()
-        if not await self.client.is_user_authorized():
-            raise Exception("Telegram session invalid - regenerate TG_SESSION")
+        await self.pool.start()
         print("Connected to Telegram")
     
     async def stop(self):
-        await self.client.disconnect()
+        await self.pool.stop()
     
-    def _file_hash(self, filepath):
-        h = hashlib.md5()
+    def _sample_hash(self, filepath, file_size):
+        """Hash of the size plus evenly spaced blocks: spots a re-upload without reading the whole file"""
+        h = hashlib.md5(str(file_size).encode())
+        step = max(SAMPLE_BLOCK_SIZE, file_size // SAMPLE_BLOCKS)
         with open(filepath, 'rb') as f:
-            while chunk := f.read(8192):
-                h.update(chunk)
+            for offset in range(0, file_size, step):
+                f.seek(offset)
+                h.update(f.read(SAMPLE_BLOCK_SIZE))
+            f.seek(max(0, file_size - SAMPLE_BLOCK_SIZE))
+            h.update(f.read())
         return h.hexdigest()
     
-    async def upload(self, filepath, progress_callback=None):
+    def _file_hash(self, filepath):
+        with PHASE_SECONDS.time(phase='file_hash'):
+            h = hashlib.md5()
+            with open(filepath, 'rb') as f:
+                while data := f.read(SCAN_BLOCK):
+                    h.update(data)
+            return h.hexdigest()
+    
+    def _chunk_sample(self, filepath, start, length):
+        """A few blocks spread over a chunk, to judge whether it compresses"""
+        step = max(COMPRESS_SAMPLE_SIZE, length // COMPRESS_SAMPLES)
+        with open(filepath, 'rb') as f:
+            return b''.join(os.pread(f.fileno(), min(COMPRESS_SAMPLE_SIZE, start + length - offset), offset)
+                            for offset in range(start, start + length, step))
+    
+    async def pack(self, source, size, sample=None):
+        """What to send for a chunk: (file object, its size, codec or None).
+
+        A chunk is compressed when its `sample` (by default its first bytes) shrinks enough, and then
+        only kept compressed if the whole of it did too. Either way `source` is read through once.
+        """
+        if not self.compression:
+            return source, size, None
+        if sample is None:
+            sample = source.read(min(size, COMPRESS_SAMPLES * COMPRESS_SAMPLE_SIZE))
+            if asyncio.iscoroutine(sample):
+                sample = await sample
+            source.seek(0)
+        packer = compressor(self.compression)
+        if not sample or len(packer.compress(sample)) + len(packer.flush()) > len(sample) * COMPRESS_RATIO:
+            return source, size, None
+        compressed = CompressedStream(source, self.compression)
+        with PHASE_SECONDS.time(phase='compress'):
+            stored = await compressed.measure()
+        if stored > size * COMPRESS_RATIO:
+            return source, size, None
+        COMPRESSION_BYTES.inc(size, side='original', codec=self.compression)
+        COMPRESSION_BYTES.inc(stored, side='stored', codec=self.compression)
+        return compressed, stored, self.compression
+    
+    def _scan(self, filepath, chunk_size, on_chunk, stop):
+        with PHASE_SECONDS.time(phase='file_hash'):
+            return scan_chunks(filepath, chunk_size, on_chunk, stop)
+    
+    async def upload(self, filepath, progress_callback=None, quick_dedup=True):
         filepath = Path(filepath)
         if not filepath.exists():
             raise FileNotFoundError(f"{filepath} not found")
         
         file_size = filepath.stat().st_size
-        file_hash = self._file_hash(filepath)
+        sample_hash = self._sample_hash(filepath, file_size)
+        
+        # Check if already uploaded. A sample match is only a candidate: an edit between the sampled blocks
+        # keeps the size and sample hash, so the whole file is hashed before the upload is skipped
+        if quick_dedup:
+            candidates = self._q("SELECT id, hash FROM files WHERE original_size = ? AND sample_hash = ?", (file_size, sample_hash), fetch='all')
+            if candidates:
+                file_hash = await asyncio.to_thread(self._file_hash, filepath)
+                for file_id, stored_hash in candidates:
+                    if stored_hash == file_hash:
+                        print(f"File already uploaded (id: {file_id})")
+                        return file_id
+        
+        # Chunks confirmed by an interrupted earlier attempt are journaled under this id and skipped.
+        # Boundaries depend on the content and the chunk size only, so a rerun cuts the file the same way
+        chunk_size = self.chunk_size
+        upload_id = f"{file_size}-{sample_hash}-cdc{chunk_size}"
+        confirmed = self.confirmed_chunks(upload_id)
+        
+        # A thread finds chunk boundaries, fingerprints and the whole-file hash in one read; chunks go out as they are found
+        loop = asyncio.get_running_loop()
+        found = asyncio.Queue()
+        stop = threading.Event()
+        scan = asyncio.ensure_future(asyncio.to_thread(
+            self._scan, filepath, chunk_size, lambda *chunk: loop.call_soon_threadsafe(found.put_nowait, chunk), stop
+        ))
+        scan.add_done_callback(lambda _: found.put_nowait(None))
+        sent = {}
+        reused = 0
+        stale = False
+        limit = asyncio.Semaphore(self.upload_concurrency)
         
-        # Check if already uploaded
+        async def send(chunk_index, start, length):
+            chunk_name = f"{filepath.stem}_chunk{chunk_index}{filepath.suffix}"
+            chunk_hash = hashlib.md5()
+            fingerprint = Fingerprint()
+            sent_before = 0
+            stored = length
+            
+            async def on_progress(done, _total):
+                # Telethon awaits this after every part, so throttling here paces the upload
+                nonlocal sent_before
+                if done < sent_before:
+                    sent_before = 0  # resent through another account after a FloodWait
+                if self.limiter:
+                    await self.limiter.consume(done - sent_before)
+                sent_before = done
+                sent[chunk_index] = done * length // stored
+                if progress_callback:
+                    progress_callback(sum(sent.values()), file_size)
+            
+            async with limit:
+                # Each chunk is read straight from its offset in the source file and hashed as it is sent
+                with FileWindow(filepath, start, length, chunk_name, hashers=(chunk_hash, fingerprint)) as window:
+                    body, stored, codec = await self.pack(window, length, self._chunk_sample(filepath, start, length))
+                    msg, channel_id, account = await self.send_chunk(
+                        body, f"📦 {filepath.name} | chunk {chunk_index} | {upload_id}", stored, chunk_name, on_progress
+                    )
+            self.journal_chunk(upload_id, filepath.name, file_size, None, chunk_index, msg.id, length, chunk_hash.hexdigest(),
+                               msg.document, channel_id, account, fingerprint.hexdigest(), codec, stored)
+            sent[chunk_index] = length
+            if codec:
+                print(f"Compressed {filepath.name} chunk {chunk_index + 1} with {codec} to {stored / length:.0%} of its size")
+            print(f"Uploaded {filepath.name} chunk {chunk_index + 1} ({sum(sent.values()) / 1024 / 1024:.1f} MB / {file_size / 1024 / 1024:.1f} MB)")
+        
+        tasks = []
+        total_chunks = 0
+        try:
+            while (chunk := await found.get()) is not None:
+                start, length, fingerprint = chunk
+                chunk_index = total_chunks
+                total_chunks += 1
+                earlier = confirmed.pop(chunk_index, None)
+                if earlier and (earlier[1], earlier[3]) != (length, fingerprint):
+                    # The file was edited in place since that run, so what it sent for this chunk is stale
+                    self.drop_chunks(upload_id, [chunk_index])
+                    stale = True
+                    earlier = None
+                    print(f"Re-sending {filepath.name} chunk {chunk_index + 1}, it changed since an earlier run")
+                if earlier:
+                    print(f"Skipping {filepath.name} chunk {chunk_index + 1}, uploaded by an earlier run")
+                elif self.reuse_chunk(upload_id, filepath.name, file_size, None, chunk_index, length, fingerprint):
+                    reused += length
+                    print(f"Skipping {filepath.name} chunk {chunk_index + 1}, its content is already on Telegram")
+                else:
+                    tasks.append(asyncio.ensure_future(send(chunk_index, start, length)))
+                    continue
+                sent[chunk_index] = length
+                if progress_callback:
+                    progress_callback(sum(sent.values()), file_size)
+            file_hash = await scan
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # Chunks already sent stay journaled, so a retry resumes from them
+            stop.set()
+            for task in tasks:
+                task.cancel()
+            raise
+        if reused:
+            print(f"Reused {reused / 1024 / 1024:.1f} MB of {filepath.name} already stored on Telegram")
+        if confirmed:
+            # Journaled past the last chunk the file now cuts into
+            self.drop_chunks(upload_id, list(confirmed))
+            stale = True
+        if stale:
+            await self.drain_deletes()
+        
+        # Files stored before sample hashes existed are only recognisable by their full hash
         existing = self._q("SELECT id FROM files WHERE hash = ?", (file_hash,), fetch='one')
         if existing:
             print(f"File already uploaded (id: {existing[0]})")
+            await self.discard_upload(upload_id)
             return existing[0]
         
-        # Create file record
-        file_id = self._insert_id(
-            "INSERT INTO files (filename, original_size, hash) VALUES (?, ?, ?)",
-            (filepath.name, file_size, file_hash)
-        )
+        if not total_chunks:
+            # Empty files have no chunks to journal
+            with self.db.transaction():
+                file_id = self._insert_id(
+                    "INSERT INTO files (filename, original_size, hash, sample_hash, chunk_count, stored_size, chunk_size, checksum) VALUES (?, ?, ?, ?, 0, 0, ?, ?)",
+                    (filepath.name, file_size, file_hash, sample_hash, chunk_size, ChunkVerifier.combine([]))
+                )
+                self._library_changed()
+            return file_id
+        file_id = self.finalize(upload_id, file_hash, sample_hash, chunk_size, total_chunks)
+        print(f"✅ Upload complete: {filepath.name} ({total_chunks} chunks)")
+        return file_id
+    
+    async def upload_packed(self, paths, on_stored=None):
+        """Upload small files together: each is appended to a shared pack message of up to pack_size bytes.
+
+        Every file still gets its own files row, with one chunk pointing at its span of the pack, so it downloads
+        with a single ranged fetch. The pack message is removed when the last file in it is deleted.
+        on_stored(path, file_id) is called as each file is recorded; returns {path: file_id}. If any pack
+        fails, the rest are still sent and the first error is raised at the end.
+        """
+        stored = {}
+        pending = {}  # file hash -> path of a file waiting in a pack
+        copies = {}  # path -> later paths in this batch with the same content
+        members = []
+        filled = 0
+        tasks = []
+        limit = asyncio.Semaphore(self.upload_concurrency)
         
-        # Split and upload chunks
-        chunk_index = 0
-        uploaded = 0
+        def record(path, file_id):
+            for same in [path, *copies.get(path, ())]:
+                stored[same] = file_id
+                if on_stored:
+                    on_stored(same, file_id)
         
-        with open(filepath, 'rb') as f:
-            while True:
-                chunk_data = f.read(CHUNK_SIZE)
-                if not chunk_data:
-                    break
-                
-                # Write chunk to temp file
-                chunk_name = f"{filepath.stem}_chunk{chunk_index}{filepath.suffix}"
-                chunk_path = Path(f"/tmp/{chunk_name}")
-                chunk_path.write_bytes(chunk_data)
-                
-                # Upload to Telegram
-                msg = await self.client.send_file(
-                    self.channel_id,
-                    chunk_path,
-                    caption=f"📦 {filepath.name} | chunk {chunk_index} | file_id:{file_id}",
-                    attributes=[DocumentAttributeFilename(chunk_name)]
+        async def send(members):
+            try:
+                pack = b''.join(payload for *_, payload in members)
+                msg, channel_id, account = await self.send_chunk(
+                    io.BytesIO(pack), f"📦 {len(members)} files, from {members[0][0].name}", len(pack), f"pack_{members[0][0].stem}.bin"
                 )
-                
-                # Save chunk record
+                # Journaled at once, so a pack whose files never get recorded is found and deleted by sweep_pending
+                upload_id = f"pack-{channel_id}-{msg.id}"
+                self.journal_chunk(upload_id, f"pack_{members[0][0].stem}.bin", len(pack), 1, 0, msg.id, len(pack), None,
+                                   msg.document, channel_id, account)
+                location = (*ChunkRef.columns(msg.document), channel_id, account)
+                with PHASE_SECONDS.time(phase='db_write'), self.db.transaction():
+                    self._q("DELETE FROM pending_chunks WHERE upload_id = ?", (upload_id,))
+                    self._q(
+                        "INSERT INTO blocks (size, message_id, doc_id, access_hash, file_reference, dc_id, channel_id, account, refs) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (len(pack), msg.id, *location, len(members))
+                    )
+                    file_ids = []
+                    offset = 0
+                    for path, size, file_hash, sample_hash, codec, payload in members:
+                        file_id = self._insert_id(
+                            "INSERT INTO files (filename, original_size, hash, sample_hash, chunk_count, stored_size, chunk_size, checksum) "
+                            "VALUES (?, ?, ?, ?, 1, ?, ?, ?)",
+                            (path.name, size, file_hash, sample_hash, len(payload), self.chunk_size, ChunkVerifier.combine([file_hash]))
+                        )
+                        self._q(
+                            "INSERT INTO chunks (file_id, chunk_index, message_id, size, hash, doc_id, access_hash, file_reference, dc_id, "
+                            "channel_id, account, codec, stored_size, pack_offset) VALUES (?, 0, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            (file_id, msg.id, size, file_hash, *location, codec, len(payload) if codec else None, offset)
+                        )
+                        file_ids.append(file_id)
+                        offset += len(payload)
+                    self._library_changed()
+                for (path, *_), file_id in zip(members, file_ids):
+                    record(path, file_id)
+                print(f"Uploaded a pack of {len(members)} files ({len(pack) / 1024 / 1024:.1f} MB)")
+            finally:
+                limit.release()
+        
+        async def flush():
+            nonlocal members, filled
+            if members:
+                # Waiting for a free slot here keeps at most upload_concurrency packs in memory besides the one filling
+                await limit.acquire()
+                tasks.append(asyncio.ensure_future(send(members)))
+            members, filled = [], 0
+        
+        try:
+            for path in map(Path, paths):
+                size = path.stat().st_size
+                sample_hash = self._sample_hash(path, size)
+                # Small files are read whole anyway, so duplicates are found by their full hash
+                data = await asyncio.to_thread(path.read_bytes)
+                file_hash = hashlib.md5(data).hexdigest()
+                existing = self._q("SELECT id FROM files WHERE hash = ?", (file_hash,), fetch='one')
+                if existing:
+                    record(path, existing[0])
+                    continue
+                if file_hash in pending:
+                    copies.setdefault(pending[file_hash], []).append(path)
+                    continue
+                pending[file_hash] = path
+                codec, payload = None, data
+                if self.compression:
+                    packer = compressor(self.compression)
+                    packed = packer.compress(data) + packer.flush()
+                    if len(packed) <= size * COMPRESS_RATIO:
+                        codec, payload = self.compression, packed
+                if filled + len(payload) > self.pack_size:
+                    await flush()
+                members.append((path, size, file_hash, sample_hash, codec, payload))
+                filled += len(payload)
+            await flush()
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        
+        errors = [e for e in await asyncio.gather(*tasks, return_exceptions=True) if isinstance(e, BaseException)]
+        if errors:
+            raise errors[0]
+        return stored
+    
+    async def send_chunk(self, file, caption, size=None, name=None, progress_callback=None):
+        """Send one chunk to the next channel through the account the pool expects to be fastest.
+
+        A FloodWait puts that account on cooldown and the chunk is resent through another one.
+        Returns (message, channel_id, account).
+        """
+        channel_id = self.channels[next(self._channel_turn) % len(self.channels)]
+        with IN_FLIGHT.track(kind='upload'):
+            while True:
+                client = None
+                try:
+                    async with self.pool.acquire() as client:
+                        began = time.monotonic()
+                        if hasattr(file, 'seek'):
+                            file.seek(0)
+                        msg = await client.send_file(
+                            channel_id,
+                            file,
+                            file_size=size,
+                            force_document=True,
+                            caption=caption,
+                            attributes=[DocumentAttributeFilename(name)] if name else None,
+                            progress_callback=progress_callback
+                        )
+                        elapsed = time.monotonic() - began
+                        self.pool.record(client, size, elapsed)
+                        PHASE_SECONDS.observe(elapsed, phase='telegram_send')
+                        TRANSFER_BYTES.inc(size or 0, direction='to_telegram')
+                        return msg, channel_id, self.pool.account_name(client)
+                except FloodWaitError as e:
+                    print(f"FloodWait on upload: resting that account for {e.seconds}s")
+                    FLOOD_WAITS.inc(operation='upload')
+                    FLOOD_WAIT_SECONDS.inc(e.seconds, operation='upload')
+                    self.pool.cooldown(client, e.seconds)
+    
+    def confirmed_chunks(self, upload_id):
+        """Chunks of an unfinished upload already on Telegram: {chunk_index: (message_id, size, hash, fingerprint)}"""
+        rows = self._q(
+            "SELECT chunk_index, message_id, chunk_size, chunk_hash, fingerprint FROM pending_chunks WHERE upload_id = ? ORDER BY id",
+            (upload_id,), fetch='all'
+        )
+        return {idx: tuple(row) for idx, *row in rows}
+    
+    def drop_chunks(self, upload_id, chunk_indexes):
+        """Let go of journaled chunks of an unfinished upload, e.g. ones a file edited since no longer matches.
+
+        Their messages are queued for deletion once nothing else points at them.
+        """
+        marks = ', '.join('?' * len(chunk_indexes))
+        with PHASE_SECONDS.time(phase='db_write'), self.db.transaction():
+            rows = self._q(
+                f"SELECT channel_id, message_id FROM pending_chunks WHERE upload_id = ? AND chunk_index IN ({marks})",
+                (upload_id, *chunk_indexes), fetch='all'
+            )
+            self._queue_deletes(self._release([(channel_id or self.channel_id, msg_id) for channel_id, msg_id in rows]))
+            self._q(f"DELETE FROM pending_chunks WHERE upload_id = ? AND chunk_index IN ({marks})", (upload_id, *chunk_indexes))
+    
+    def journal_chunk(self, upload_id, filename, total_size, total_chunks, chunk_index, message_id, size, chunk_hash, document=None, channel_id=None, account=None, fingerprint=None, codec=None, stored_size=None):
+        """Record a chunk just sent; with a fingerprint, later uploads of the same bytes can point at it too.
+
+        `size` and `chunk_hash` are of the original bytes; a chunk sent compressed also gives its codec and stored_size.
+        """
+        location = (*ChunkRef.columns(document), channel_id or self.channel_id, account, codec, stored_size if codec else None)
+        with PHASE_SECONDS.time(phase='db_write'), self.db.transaction():
+            self._q(
+                "INSERT INTO pending_chunks (upload_id, filename, total_size, total_chunks, chunk_index, message_id, chunk_size, chunk_hash, "
+                "doc_id, access_hash, file_reference, dc_id, channel_id, account, codec, stored_size, fingerprint, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)",
+                (upload_id, filename, total_size, total_chunks, chunk_index, message_id, size, chunk_hash, *location, fingerprint)
+            )
+            if fingerprint:
                 self._q(
-                    "INSERT INTO chunks (file_id, chunk_index, message_id, size) VALUES (?, ?, ?, ?)",
-                    (file_id, chunk_index, msg.id, len(chunk_data))
+                    "INSERT INTO blocks (fingerprint, size, hash, message_id, doc_id, access_hash, file_reference, dc_id, channel_id, account, "
+                    "codec, stored_size, refs) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1)",
+                    (fingerprint, size, chunk_hash, message_id, *location)
                 )
-                
-                chunk_path.unlink()  # Clean up temp file
-                
-                uploaded += len(chunk_data)
-                if progress_callback:
-                    progress_callback(uploaded, file_size)
-                
-                chunk_index += 1
-                print(f"Uploaded chunk {chunk_index} ({uploaded / 1024 / 1024:.1f} MB / {file_size / 1024 / 1024:.1f} MB)")
-        
-        print(f"✅ Upload complete: {filepath.name} ({chunk_index} chunks)")
+    
+    def reuse_chunk(self, upload_id, filename, total_size, total_chunks, chunk_index, size, fingerprint):
+        """Journal a chunk whose bytes are already on Telegram by pointing at the stored message; returns whether it could"""
+        block = self._q(
+            "SELECT id, message_id, hash, doc_id, access_hash, file_reference, dc_id, channel_id, account, codec, stored_size FROM blocks "
+            "WHERE fingerprint = ? AND size = ? AND refs > 0 LIMIT 1",
+            (fingerprint, size), fetch='one'
+        )
+        if not block:
+            return False
+        with PHASE_SECONDS.time(phase='db_write'), self.db.transaction():
+            # Lost if the last file using it was deleted meanwhile; the chunk is then sent after all
+            if self._q("UPDATE blocks SET refs = refs + 1 WHERE id = ? AND refs > 0", (block[0],)) != 1:
+                return False
+            self._q(
+                "INSERT INTO pending_chunks (upload_id, filename, total_size, total_chunks, chunk_index, message_id, chunk_size, chunk_hash, "
+                "doc_id, access_hash, file_reference, dc_id, channel_id, account, codec, stored_size, fingerprint, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)",
+                (upload_id, filename, total_size, total_chunks, chunk_index, block[1], size, *block[2:], fingerprint)
+            )
+        return True
+    
+    def finalize(self, upload_id, file_hash=None, sample_hash=None, chunk_size=None, total_chunks=None):
+        """Turn a fully journaled upload into a file record; returns None if the upload is unknown.
+
+        Finalizing an upload that was already finalized returns the file it became.
+        `total_chunks` is for callers that only knew the count after journaling.
+        """
+        with PHASE_SECONDS.time(phase='db_write'), self.db.transaction():
+            chunks = self._q(
+                "SELECT filename, total_size, total_chunks, chunk_index, message_id, chunk_size, chunk_hash, doc_id, access_hash, file_reference, dc_id, "
+                "channel_id, account, codec, stored_size, id FROM pending_chunks WHERE upload_id = ? ORDER BY chunk_index, id DESC",
+                (upload_id,), fetch='all'
+            )
+            if not chunks:
+                return self._finalized(upload_id, file_hash)
+            
+            filename, total_size = chunks[0][:2]
+            if total_chunks is None:
+                total_chunks = chunks[0][2]
+            by_index = {}
+            extra = []
+            for row in chunks:
+                if row[3] in by_index or row[3] >= total_chunks:
+                    # Journaled twice (a retried request whose first attempt got through): the latest copy is kept
+                    # and the older ones let go, as is anything past the last chunk
+                    extra.append((row[11] or self.channel_id, row[4]))
+                else:
+                    by_index[row[3]] = row[4:-1]
+            missing = sorted(set(range(total_chunks)) - set(by_index))
+            if missing:
+                raise ValueError(f"Upload {upload_id} is missing chunks {missing}")
+            journaled = sum(row[1] for row in by_index.values())
+            if journaled != total_size:
+                raise ValueError(f"Upload {upload_id} has {journaled} bytes journaled for a {total_size} byte file")
+            
+            # The rows are claimed before anything is recorded. Another finalize of this upload (a second tab with the
+            # same file, a retried request) read them too, and two files on one count of block references would
+            # have the first delete take the chunks out from under the other
+            ids = [row[-1] for row in chunks]
+            claimed = sum(self._q(f"DELETE FROM pending_chunks WHERE id IN ({', '.join('?' * len(batch))})", batch)
+                          for batch in (ids[start:start + 500] for start in range(0, len(ids), 500)))
+            if claimed == 0:
+                return self._finalized(upload_id, file_hash)
+            if claimed != len(ids):
+                raise ValueError(f"Upload {upload_id} changed while it was being finalized")
+            file_id = self._insert_id(
+                "INSERT INTO files (filename, original_size, hash, sample_hash, chunk_count, stored_size, chunk_size, checksum) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (filename, total_size, file_hash or upload_id, sample_hash, len(by_index), sum(row[10] or row[1] for row in by_index.values()),
+                 chunk_size or by_index[0][1], ChunkVerifier.combine([row[2] for _, row in sorted(by_index.items())]))
+            )
+            self._qmany(
+                "INSERT INTO chunks (file_id, chunk_index, message_id, size, hash, doc_id, access_hash, file_reference, dc_id, channel_id, account, "
+                "codec, stored_size) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(file_id, idx, *row) for idx, row in sorted(by_index.items())]
+            )
+            self._queue_deletes(self._release(extra))
+            self._library_changed()
         return file_id
     
+    def _finalized(self, upload_id, file_hash=None):
+        """The file another finalize of this upload recorded, if any"""
+        existing = self._q("SELECT id FROM files WHERE hash = ? ORDER BY id DESC", (file_hash or upload_id,), fetch='one')
+        return existing[0] if existing else None
+    
+    async def discard_upload(self, upload_id):
+        """Forget an unfinished upload and delete the chunks it already sent"""
+        with self.db.transaction():
+            rows = self._q("SELECT channel_id, message_id FROM pending_chunks WHERE upload_id = ?", (upload_id,), fetch='all')
+            self._queue_deletes(self._release([(channel_id or self.channel_id, msg_id) for channel_id, msg_id in rows]))
+            self._q("DELETE FROM pending_chunks WHERE upload_id = ?", (upload_id,))
+        await self.drain_deletes()
+    
+    async def sweep_pending(self, max_age_hours=24):
+        """Discard uploads that haven't confirmed a chunk for max_age_hours; returns how many"""
+        cutoff, params = self._ago(max_age_hours * 3600)
+        stale = self._q(
+            f"SELECT upload_id FROM pending_chunks GROUP BY upload_id HAVING MAX(created_at) IS NULL OR MAX(created_at) < {cutoff}",
+            params, fetch='all'
+        )
+        for (upload_id,) in stale:
+            await self.discard_upload(upload_id)
+        return len(stale)
+    
     async def download(self, file_id, output_dir=".", progress_callback=None):
         output_dir = Path(output_dir)
         output_dir.mkdir(exist_ok=True)
@@ -169,49 +1468,693 @@ class TelegramStorage:
         
         filename, original_size = file_info
         output_path = output_dir / filename
+        await self.fetch_to(file_id, output_path, progress_callback)
         
-        # Get chunks
+        print(f"✅ Download complete: {output_path}")
+        return output_path
+    
+    def create_job(self, job_id, kind, total=0):
+        self._q("INSERT INTO jobs (id, kind, status, bytes_done, bytes_total) VALUES (?, ?, 'running', 0, ?)", (job_id, kind, total))
+    
+    def claim_job(self, job_id, kind, total=0):
+        """Create job_id unless a live job with that id is already running; returns whether the caller should run it"""
+        cutoff, params = self._ago(JOB_STALE_SECONDS)
+        with self.db.transaction():
+            self._q(f"DELETE FROM jobs WHERE id = ? AND (status != 'running' OR updated_at < {cutoff})", (job_id, *params))
+            return self._q(
+                "INSERT INTO jobs (id, kind, status, bytes_done, bytes_total) VALUES (?, ?, 'running', 0, ?) ON CONFLICT (id) DO NOTHING",
+                (job_id, kind, total)
+            ) == 1
+    
+    def finish_job(self, job_id, result=None, error=None):
+        self._q(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+            ('error' if error else 'done', json.dumps(result), error, job_id)
+        )
+    
+    def job_progress(self, job_id, progress):
+        self._q(
+            "UPDATE jobs SET bytes_done = ?, bytes_total = ?, rate = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+            (progress.done, progress.total, progress.rate, job_id)
+        )
+    
+    def get_job(self, job_id):
+        row = self._q("SELECT kind, status, result, error, bytes_done, bytes_total, rate FROM jobs WHERE id = ?", (job_id,), fetch='one')
+        if not row:
+            return None
+        kind, status, result, error, done, total, rate = row
+        eta = (total - done) / rate if rate and total else None
+        return {'id': job_id, 'kind': kind, 'status': status, 'result': json.loads(result) if result else None, 'error': error,
+                'bytes': done or 0, 'total': total or 0, 'rate': rate or 0, 'eta': eta}
+    
+    def prune_jobs(self, max_age_hours=24):
+        cutoff, params = self._ago(max_age_hours * 3600)
+        self._q(f"DELETE FROM jobs WHERE status != 'running' AND updated_at < {cutoff}", params)
+    
+    def _ago(self, seconds):
+        """SQL for the database clock `seconds` ago, and its params.
+
+        Timestamps are filled by CURRENT_TIMESTAMP, which Postgres keeps in the session time zone, so cutoffs
+        are worked out by the database too rather than from Python's UTC clock.
+        """
+        if self.db.pg:
+            return "CURRENT_TIMESTAMP - ? * INTERVAL '1 second'", (seconds,)
+        return "datetime('now', ?)", (f"{-seconds} seconds",)
+    
+    def _chunks(self, file_id):
+        """(channel_id, message_id, offset), chunk_index, size, hash for each chunk of a file, in order"""
         chunks = self._q(
-            "SELECT message_id, chunk_index, size FROM chunks WHERE file_id = ? ORDER BY chunk_index",
+            "SELECT channel_id, message_id, pack_offset, chunk_index, size, hash FROM chunks WHERE file_id = ? ORDER BY chunk_index",
             (file_id,), fetch='all'
         )
-        
         if not chunks:
             raise ValueError(f"No chunks found for file {file_id}")
+        return [((channel_id or self.channel_id, msg_id, offset or 0), idx, size, chunk_hash)
+                for channel_id, msg_id, offset, idx, size, chunk_hash in chunks]
+    
+    async def _refs(self, keys):
+        """ChunkRef per (channel_id, message_id, offset); only chunks uploaded before documents were recorded cost a lookup, batched"""
+        wanted = set(keys)
+        msg_ids = sorted({key[1] for key in wanted})
+        refs = {}
+        encodings = {}
+        for start in range(0, len(msg_ids), 500):
+            batch = msg_ids[start:start + 500]
+            rows = self._q(
+                "SELECT channel_id, message_id, pack_offset, doc_id, access_hash, file_reference, dc_id, account, codec, stored_size FROM chunks "
+                f"WHERE message_id IN ({', '.join('?' * len(batch))})",
+                batch, fetch='all'
+            )
+            for channel_id, msg_id, offset, *location, codec, stored_size in rows:
+                key = (channel_id or self.channel_id, msg_id, offset or 0)
+                if key in wanted:
+                    encodings[key] = (codec, stored_size)
+                    if location[0] is not None:
+                        refs[key] = ChunkRef.from_row(*key[:2], *location, codec, stored_size, key[2])
+        missing = [key for key in wanted if key not in refs]
+        if missing:
+            for key, ref in (await self._lookup(missing)).items():
+                ref.codec, ref.stored_size = encodings.get(key, (None, None))
+                refs[key] = ref
+        return refs
+    
+    async def _lookup(self, keys):
+        """Fetch chunk documents from their messages, 100 per request, and record them for next time.
+
+        Keys are (channel_id, message_id), or chunk keys with an offset; the refs returned are keyed the same way.
+        """
+        found = await self._documents({key[:2] for key in keys})
+        for (_, msg_id), (doc, _) in found.items():
+            if doc is None:
+                raise ValueError(f"Chunk message {msg_id} is missing from Telegram")
+        refs = {}
+        for key in keys:
+            doc, account = found[key[:2]]
+            refs[key] = ChunkRef(*key[:2], doc.id, doc.access_hash, doc.file_reference, doc.dc_id, account, offset=key[2] if len(key) > 2 else 0)
+        return refs
+    
+    async def _documents(self, keys):
+        """{(channel_id, message_id): (document or None if the message is gone, account)}, 100 per request.
+
+        Documents found are recorded on their chunk rows, so later downloads skip the lookup.
+        """
+        found = {}
+        by_channel = {}
+        for channel_id, msg_id in keys:
+            by_channel.setdefault(channel_id, []).append(msg_id)
+        for channel_id, msg_ids in by_channel.items():
+            for start in range(0, len(msg_ids), 100):
+                batch = msg_ids[start:start + 100]
+                async with self.pool.acquire() as client:
+                    messages = await client.get_messages(channel_id, ids=batch)
+                    account = self.pool.account_name(client)
+                for msg_id, msg in zip(batch, messages):
+                    found[(channel_id, msg_id)] = (msg.document if msg else None, account)
+        self._qmany(
+            "UPDATE chunks SET doc_id = ?, access_hash = ?, file_reference = ?, dc_id = ?, account = ? WHERE message_id = ? AND COALESCE(channel_id, ?) = ?",
+            [(*ChunkRef.columns(doc), account, msg_id, self.channel_id, channel_id) for (channel_id, msg_id), (doc, account) in found.items() if doc is not None]
+        )
+        return found
+    
+    async def _refresh(self, ref, stale):
+        """Replace an expired file reference; concurrent ranges of the same chunk share one lookup"""
+        async with ref.refreshing:
+            if ref.location.file_reference == stale:
+                fresh = (await self._lookup([ref.key]))[ref.key]
+                ref.location = fresh.location
+                ref.dc_id = fresh.dc_id
+                ref.account = fresh.account
+    
+    def _cache_key(self, key):
+        channel_id, msg_id, offset = key
+        return f"{channel_id}_{msg_id}_{offset}" if offset else f"{channel_id}_{msg_id}"
+    
+    async def _fetch_into(self, ref, size, write_at, on_data, limit):
+        """Fetch a whole chunk as concurrent part ranges, handing each piece to write_at(offset, data)"""
+        if ref.codec:
+            # Compressed data only decodes from the start, so the document comes down as one stream
+            async with limit:
+                done = 0
+                async for data in self._iter_chunk(ref, size):
+                    write_at(done, data)
+                    done += len(data)
+                    on_data(len(data))
+            return
+        
+        async def fetch_range(start, length):
+            async with limit:
+                done = 0
+                async for data in self._iter_range(ref, start, length):
+                    write_at(start + done, data)
+                    done += len(data)
+                    on_data(len(data))
         
-        # Download and reassemble
-        downloaded = 0
-        with open(output_path, 'wb') as out:
-            for msg_id, idx, size in chunks:
-                msg = await self.client.get_messages(self.channel_id, ids=msg_id)
-                chunk_path = await self.client.download_media(msg, file=f"/tmp/chunk_{idx}")
+        await asyncio.gather(*(fetch_range(start, min(PART_SPAN, size - start)) for start in range(0, size, PART_SPAN)))
+    
+    async def _iter_chunk(self, ref, size):
+        """Yield a chunk's original bytes in order, decompressing them on the way if it was sent compressed"""
+        if not ref.codec:
+            async for data in self._iter_range(ref, 0, size):
+                yield data
+            return
+        decompressor = Decompressor(ref.codec)
+        done = 0
+        async for data in self._iter_range(ref, 0, ref.stored_size):
+            for out in decompressor.feed(data):
+                done += len(out)
+                if done > size:
+                    raise ChecksumError(f"Chunk message {ref.msg_id} decompresses to more than {size} bytes")
+                yield out
+    
+    async def fetch_to(self, file_id, output_path, progress_callback=None):
+        """Download all chunks of a file into output_path, fetching part ranges concurrently.
+
+        Every chunk is checked against its recorded hash as it lands; raises ChecksumError on a mismatch.
+        """
+        with IN_FLIGHT.track(kind='download'), PHASE_SECONDS.time(phase='reassembly'):
+            chunks = self._chunks(file_id)
+            total = sum(size for _, _, size, _ in chunks)
+            limit = asyncio.Semaphore(self.download_concurrency)
+            downloaded = 0
+            
+            def on_data(n):
+                nonlocal downloaded
+                downloaded += n
+                if progress_callback:
+                    progress_callback(downloaded, total)
+            
+            with open(output_path, 'w+b') as out:
+                out.truncate(total)
                 
-                with open(chunk_path, 'rb') as chunk_file:
-                    out.write(chunk_file.read())
+                def write_at(offset, data):
+                    # Each part is written straight to its final offset in the output file
+                    out.seek(offset)
+                    out.write(data)
                 
-                Path(chunk_path).unlink()  # Clean up
+                def read_at(offset, length):
+                    out.flush()
+                    return os.pread(out.fileno(), length, offset)
                 
-                downloaded += size
-                if progress_callback:
-                    progress_callback(downloaded, original_size)
-                print(f"Downloaded chunk {idx + 1}/{len(chunks)} ({downloaded / 1024 / 1024:.1f} MB)")
+                async def fetch_chunk(key, idx, size, chunk_hash, dest):
+                    verifier = ChunkVerifier(chunk_hash, size, lambda offset, length: read_at(dest + offset, length), f"Chunk {idx} of file {file_id}")
+                    cached = self.cache and self.cache.open(self._cache_key(key))
+                    if cached:
+                        read = 0
+                        with cached:
+                            for pos in range(0, size, STREAM_WINDOW):
+                                data = await asyncio.to_thread(cached.read, STREAM_WINDOW)
+                                TRANSFER_BYTES.inc(len(data), direction='from_cache')
+                                write_at(dest + pos, data)
+                                verifier.update(data)
+                                read += len(data)
+                                on_data(len(data))
+                        try:
+                            verifier.check()
+                        except ChecksumError as e:
+                            # A corrupt entry would fail every later download too: it is dropped and the chunk fetched from Telegram
+                            print(f"{e}; discarding it from the cache")
+                            self.cache.discard(self._cache_key(key))
+                            on_data(-read)
+                            verifier = ChunkVerifier(chunk_hash, size, verifier.read_at, verifier.name)
+                            cached = None
+                    if not cached:
+                        def write_chunk(offset, data):
+                            write_at(dest + offset, data)
+                            verifier.written(offset, len(data))
+                        
+                        await self._fetch_into(refs[key], size, write_chunk, on_data, limit)
+                    verifier.check()
+                    print(f"Downloaded chunk {idx + 1}/{len(chunks)} ({downloaded / 1024 / 1024:.1f} MB / {total / 1024 / 1024:.1f} MB)")
+                    return verifier.hexdigest()
+                
+                refs = await self._refs([key for key, _, _, _ in chunks])
+                offsets = [0]
+                for _, _, size, _ in chunks:
+                    offsets.append(offsets[-1] + size)
+                digests = await asyncio.gather(*(
+                    fetch_chunk(key, idx, size, chunk_hash, offsets[i])
+                    for i, (key, idx, size, chunk_hash) in enumerate(chunks)
+                ))
+            
+            # The chunk list itself is checked too, so a lost or reordered chunk row can't pass unnoticed
+            checksum = self._q("SELECT checksum FROM files WHERE id = ?", (file_id,), fetch='one')[0]
+            if checksum and ChunkVerifier.combine(digests) != checksum:
+                raise ChecksumError(f"File {file_id} doesn't match its checksum")
+            return output_path
+    
+    async def warm(self, file_id, progress_callback=None):
+        """Fetch every chunk of a file that isn't in the local cache yet"""
+        chunks = self._chunks(file_id)
+        total = sum(size for _, _, size, _ in chunks)
+        if not self.cache or not all(self.cache.cacheable(size) for _, _, size, _ in chunks):
+            raise ValueError(f"File {file_id} can't be held by the chunk cache")
+        limit = asyncio.Semaphore(self.download_concurrency)
+        done = 0
         
-        print(f"✅ Download complete: {output_path}")
-        return output_path
+        def on_data(n):
+            nonlocal done
+            done += n
+            if progress_callback:
+                progress_callback(done, total)
+        
+        refs = await self._refs([key for key, _, _, _ in chunks])
+        for key, _, size, chunk_hash in chunks:
+            await self._fill_cache(refs[key], size, on_data, limit, chunk_hash)
+    
+    async def _fill_cache(self, ref, size, on_data, limit, chunk_hash=None):
+        key = self._cache_key(ref.chunk_key)
+        reported = 0
+        
+        def report(done):
+            nonlocal reported
+            on_data(done - reported)
+            reported = done
+        
+        while not self.cache.contains(key):
+            writer = self.cache.writer(key, size)
+            if writer is None:
+                # Another request, possibly in another worker, is already fetching this chunk: wait on its progress
+                follower = self.cache.follow(key)
+                if follower:
+                    with follower:
+                        while follower.active():
+                            report(follower.available())
+                            await asyncio.sleep(FOLLOW_POLL)
+                else:
+                    await asyncio.sleep(FOLLOW_POLL)
+                continue
+            report(0)
+            # Checked before commit, so a corrupt chunk never becomes a cache entry
+            verifier = ChunkVerifier(chunk_hash, size, writer.read_at, f"Chunk message {ref.msg_id}")
+            
+            def write_at(offset, data):
+                writer.write_at(offset, data)
+                verifier.written(offset, len(data))
+            
+            try:
+                await self._fetch_into(ref, size, write_at, lambda n: report(reported + n), limit)
+                verifier.check()
+                writer.commit()
+            finally:
+                writer.abort()
+        report(size)
+    
+    async def stream(self, file_id, start=0, end=None):
+        """Yield bytes [start, end) of a file in order, from the chunk cache or as they arrive from Telegram.
+
+        Whole chunks are checked against their recorded hash, and the last piece of each is held back until
+        the check passes, so a corrupt chunk ends the stream short instead of being delivered in full.
+        """
+        with IN_FLIGHT.track(kind='stream'), PHASE_SECONDS.time(phase='stream_out'):
+            # Only chunks overlapping the requested span are looked up and fetched
+            spans = []
+            offset = 0
+            for key, idx, size, chunk_hash in self._chunks(file_id):
+                lo = max(start, offset) - offset
+                hi = (size if end is None else min(end, offset + size) - offset)
+                if lo < hi:
+                    verifier = ChunkVerifier(chunk_hash, size, name=f"Chunk {idx} of file {file_id}") if lo == 0 and hi == size else None
+                    spans.append((key, size, lo, hi, verifier))
+                offset += size
+            refs = await self._refs([key for key, _, _, _, _ in spans])
+            
+            for key, size, lo, hi, verifier in spans:
+                # Closed explicitly so an abandoned stream releases its cache fill straight away
+                pieces = self._stream_chunk(refs[key], size, lo, hi, verifier)
+                held = None
+                try:
+                    async for data in pieces:
+                        if held is not None:
+                            TRANSFER_BYTES.inc(len(held), direction='to_client')
+                            yield held
+                        held = data
+                finally:
+                    await pieces.aclose()
+                if verifier:
+                    verifier.check()
+                if held is not None:
+                    TRANSFER_BYTES.inc(len(held), direction='to_client')
+                    yield held
+    
+    async def _stream_chunk(self, ref, size, lo, hi, verifier=None):
+        key = self._cache_key(ref.chunk_key)
+        cached = self.cache and self.cache.open(key)
+        if cached:
+            with cached:
+                cached.seek(lo)
+                for pos in range(lo, hi, STREAM_WINDOW):
+                    data = await asyncio.to_thread(cached.read, min(STREAM_WINDOW, hi - pos))
+                    if not data:
+                        self.cache.discard(key)
+                        raise EOFError(f"Cached chunk {key} is truncated")
+                    TRANSFER_BYTES.inc(len(data), direction='from_cache')
+                    if verifier:
+                        verifier.update(data)
+                    yield data
+            if verifier:
+                try:
+                    verifier.check()
+                except ChecksumError:
+                    # This stream ends short, but the next request fetches the chunk from Telegram again
+                    self.cache.discard(key)
+                    raise
+            return
+        
+        follower = self.cache and self.cache.follow(key)
+        if follower:
+            with follower:
+                # A seek far past what the other request has fetched so far is quicker to serve directly
+                if lo <= follower.available() + PART_SPAN:
+                    async for data in self._follow(follower, lo, hi):
+                        lo += len(data)
+                        if verifier:
+                            verifier.update(data)
+                        yield data
+            if lo == hi:
+                return
+            # The fill we were following stopped short; fetch the rest ourselves
+        
+        # Reading a whole chunk from Telegram fills the cache on the way through
+        writer = self.cache.writer(key, size) if self.cache and lo == 0 and hi == size else None
+        
+        async def fetch(start, length):
+            return b''.join([data async for data in self._iter_range(ref, start, length)])
+        
+        # A compressed document is read from its start whatever part of the chunk is wanted
+        decompressor = Decompressor(ref.codec) if ref.codec else None
+        begin, stop = (0, ref.stored_size) if decompressor else (lo, hi)
+        decoded = 0
+        
+        # A few windows download ahead; nothing more is fetched until the reader catches up
+        pending = deque()
+        
+        async def take():
+            nonlocal decoded
+            data = await pending.popleft()
+            pieces = [data]
+            if decompressor:
+                pieces = []
+                for out in decompressor.feed(data):
+                    piece = out[max(0, lo - decoded):max(0, hi - decoded)]
+                    decoded += len(out)
+                    if piece:
+                        pieces.append(piece)
+            for piece in pieces:
+                if writer:
+                    writer.write(piece)
+                if verifier:
+                    verifier.update(piece)
+            return pieces
+        
+        try:
+            for pos in range(begin, stop, STREAM_WINDOW):
+                if decoded >= hi:
+                    break
+                pending.append(asyncio.ensure_future(fetch(pos, min(STREAM_WINDOW, stop - pos))))
+                if len(pending) >= STREAM_PREFETCH:
+                    for piece in await take():
+                        yield piece
+            while pending and decoded < hi:
+                for piece in await take():
+                    yield piece
+            if writer:
+                # The writer only exists for whole-chunk reads, which always have a verifier
+                verifier.check()
+                writer.commit()
+        finally:
+            for task in pending:
+                task.cancel()
+            if writer:
+                writer.abort()
+    
+    async def _follow(self, follower, lo, hi):
+        """Yield [lo, hi) of a chunk as another request's fill writes it; stops early if that fill ends short"""
+        pos = lo
+        while pos < hi:
+            available = follower.available()
+            if available > pos:
+                data = await asyncio.to_thread(follower.read, pos, min(STREAM_WINDOW, hi - pos, available - pos))
+                pos += len(data)
+                yield data
+            elif not follower.active() and follower.available() <= pos:
+                return
+            else:
+                await asyncio.sleep(FOLLOW_POLL)
+    
+    async def _iter_range(self, ref, start, length):
+        """Yield `length` bytes of a chunk from `start` (into its span of the document), resuming after FloodWait, dropped connections and expired file references"""
+        done = 0
+        attempt = 0
+        while done < length:
+            offset = ref.offset + start + done
+            skip = offset % REQUEST_SIZE  # requests must start on a REQUEST_SIZE boundary
+            file_reference = ref.location.file_reference
+            client = None
+            try:
+                async with self.pool.acquire(ref.account) as client:
+                    stream = client.iter_download(ref.location, offset=offset - skip, request_size=REQUEST_SIZE, dc_id=ref.dc_id)
+                    fetched = 0
+                    fetch_time = 0
+                    try:
+                        while True:
+                            # Only time spent waiting on Telegram counts towards the account's throughput
+                            began = time.monotonic()
+                            try:
+                                data = await stream.__anext__()
+                            except StopAsyncIteration:
+                                break
+                            fetch_time += time.monotonic() - began
+                            fetched += len(data)
+                            data = bytes(data[skip:skip + length - done])
+                            skip = 0
+                            if not data:
+                                break
+                            done += len(data)
+                            attempt = 0
+                            TRANSFER_BYTES.inc(len(data), direction='from_telegram')
+                            if self.limiter:
+                                await self.limiter.consume(len(data))
+                            yield data
+                            if done >= length:
+                                break
+                    finally:
+                        await stream.close()
+                        self.pool.record(client, fetched, fetch_time)
+                if done < length:
+                    raise EOFError(f"Telegram returned {done} of {length} bytes")
+            except FloodWaitError as e:
+                # The pool holds this account back until the wait is over
+                print(f"FloodWait: resting that account for {e.seconds}s")
+                FLOOD_WAITS.inc(operation='download')
+                FLOOD_WAIT_SECONDS.inc(e.seconds, operation='download')
+                self.pool.cooldown(client, e.seconds)
+            except FileReferenceExpiredError:
+                attempt += 1
+                if attempt > MAX_RETRIES:
+                    raise
+                RETRIES.inc(reason='file_reference')
+                print(f"File reference of chunk message {ref.msg_id} expired, refreshing")
+                await self._refresh(ref, file_reference)
+            except (ConnectionError, asyncio.TimeoutError) as e:
+                attempt += 1
+                if attempt > MAX_RETRIES:
+                    raise
+                RETRIES.inc(reason='connection')
+                print(f"Download interrupted ({e}), retrying in {2 ** attempt}s")
+                await asyncio.sleep(2 ** attempt)
     
-    def list_files(self):
-        return self._q("""
-            SELECT f.id, f.filename, f.original_size, f.created_at, COUNT(c.id) as chunks
-            FROM files f LEFT JOIN chunks c ON f.id = c.file_id
-            GROUP BY f.id, f.filename, f.original_size, f.created_at ORDER BY f.created_at DESC
-        """, fetch='all')
+    def _file_filter(self, search=None, extensions=None):
+        clauses, params = [], []
+        if search:
+            escaped = search.lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            clauses.append("LOWER(filename) LIKE ? ESCAPE '\\'")
+            params.append(f"%{escaped}%")
+        if extensions:
+            clauses.append('(' + ' OR '.join("LOWER(filename) LIKE ?" for _ in extensions) + ')')
+            params.extend(f"%.{ext.lower()}" for ext in extensions)
+        return (' WHERE ' + ' AND '.join(clauses) if clauses else ''), params
+    
+    def list_files(self, limit=None, before=None, search=None, extensions=None):
+        """Newest first; pass the last id of a page as `before` to fetch the next one"""
+        where, params = self._file_filter(search, extensions)
+        if before is not None:
+            where += (' AND ' if where else ' WHERE ') + 'id < ?'
+            params.append(before)
+        query = f"SELECT id, filename, original_size, created_at, chunk_count FROM files{where} ORDER BY id DESC"
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(limit)
+        return self._q(query, params, fetch='all')
+    
+    def library_stats(self, search=None, extensions=None):
+        """(file count, total size) of the files matching the filter"""
+        where, params = self._file_filter(search, extensions)
+        count, total = self._q(f"SELECT COUNT(*), COALESCE(SUM(original_size), 0) FROM files{where}", params, fetch='one')
+        return count, total
+    
+    def library_version(self):
+        return self._q("SELECT version FROM library WHERE id = 1", fetch='one')[0]
+    
+    def _library_changed(self):
+        self._q("UPDATE library SET version = version + 1 WHERE id = 1")
+    
+    def find_files(self, search=None, extensions=None):
+        """Ids of the files a listing with the same filter would show"""
+        where, params = self._file_filter(search, extensions)
+        return [file_id for (file_id,) in self._q(f"SELECT id FROM files{where}", params, fetch='all')]
+    
+    def delete_files(self, file_ids):
+        """Remove files from the library at once and queue their chunk messages for drain_deletes(); returns how many existed"""
+        file_ids = list(file_ids)
+        deleted = 0
+        chunk_keys = []
+        with self.db.transaction():
+            for start in range(0, len(file_ids), 500):
+                batch = file_ids[start:start + 500]
+                marks = ', '.join('?' * len(batch))
+                rows = self._q(f"SELECT channel_id, message_id, pack_offset FROM chunks WHERE file_id IN ({marks})", batch, fetch='all')
+                chunk_keys.extend((channel_id or self.channel_id, msg_id, offset or 0) for channel_id, msg_id, offset in rows)
+                self._q(f"DELETE FROM chunks WHERE file_id IN ({marks})", batch)
+                deleted += self._q(f"DELETE FROM files WHERE id IN ({marks})", batch)
+            # Messages other files still share stay on Telegram
+            messages = self._release([key[:2] for key in chunk_keys])
+            self._queue_deletes(messages)
+            if deleted:
+                self._library_changed()
+        if self.cache:
+            freed = set(messages)
+            for key in chunk_keys:
+                if key[:2] in freed:
+                    self.cache.discard(self._cache_key(key))
+        return deleted
+    
+    def _release(self, keys):
+        """Drop one reference to each (channel_id, message_id); returns the messages nothing points at any more.
+
+        Chunks sent before blocks were tracked were never shared, so they are returned as they are.
+        """
+        keys = list(keys)
+        free = []
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            msg_ids = sorted({msg_id for _, msg_id in batch})
+            marks = ', '.join('?' * len(msg_ids))
+            tracked = {tuple(row) for row in self._q(f"SELECT channel_id, message_id FROM blocks WHERE message_id IN ({marks})", msg_ids, fetch='all')}
+            self._qmany("UPDATE blocks SET refs = refs - 1 WHERE channel_id = ? AND message_id = ?", [key for key in batch if key in tracked])
+            free.extend(key for key in batch if key not in tracked)
+            rows = self._q(f"SELECT channel_id, message_id FROM blocks WHERE refs <= 0 AND message_id IN ({marks})", msg_ids, fetch='all')
+            free.extend(key for key in map(tuple, rows) if key in tracked)
+            self._q(f"DELETE FROM blocks WHERE refs <= 0 AND message_id IN ({marks})", msg_ids)
+        return list(dict.fromkeys(free))
+    
+    def _queue_deletes(self, keys):
+        self._qmany("INSERT INTO delete_queue (channel_id, message_id, attempts, created_at) VALUES (?, ?, 0, CURRENT_TIMESTAMP)", keys)
+    
+    async def drain_deletes(self):
+        """Delete queued chunk messages from Telegram in batches; a failed batch stays queued for the next drain"""
+        removed = 0
+        async with self._draining:
+            while True:
+                rows = self._q(
+                    f"SELECT id, channel_id, message_id FROM delete_queue WHERE attempts < ? ORDER BY id LIMIT {DELETE_BATCH}",
+                    (DELETE_ATTEMPTS,), fetch='all'
+                )
+                if not rows:
+                    return removed
+                # One request per channel; the oldest entry's channel goes first
+                rows = [row for row in rows if row[1] == rows[0][1]]
+                channel_id = rows[0][1] or self.channel_id
+                ids = [row_id for row_id, _, _ in rows]
+                marks = ', '.join('?' * len(ids))
+                client = None
+                try:
+                    async with self.pool.acquire() as client:
+                        await client.delete_messages(channel_id, [msg_id for _, _, msg_id in rows])
+                except FloodWaitError as e:
+                    print(f"FloodWait: resting that account for {e.seconds}s")
+                    FLOOD_WAITS.inc(operation='delete')
+                    FLOOD_WAIT_SECONDS.inc(e.seconds, operation='delete')
+                    self.pool.cooldown(client, e.seconds)
+                    continue
+                except Exception as e:
+                    print(f"Deleting {len(rows)} messages failed ({e}), left queued")
+                    self._q(f"UPDATE delete_queue SET attempts = attempts + 1, error = ? WHERE id IN ({marks})", (str(e), *ids))
+                    return removed
+                self._q(f"DELETE FROM delete_queue WHERE id IN ({marks})", ids)
+                removed += len(rows)
     
     async def delete(self, file_id):
-        chunks = self._q("SELECT message_id FROM chunks WHERE file_id = ?", (file_id,), fetch='all')
+        if self.delete_files([file_id]):
+            await self.drain_deletes()
+            print(f"Deleted file {file_id}")
+        else:
+            print(f"File {file_id} not found")
+    
+    async def scrub(self, file_ids=None, deep=False, pause=SCRUB_PAUSE):
+        """Confirm every chunk's message still holds the document recorded at upload.
+
+        With deep, each chunk is also downloaded (under the bandwidth limit) and checked against its hash.
+        Returns {'files', 'chunks', 'bytes', 'problems': [(file_id, filename, chunk_index, problem)]}.
+        """
+        query = ("SELECT f.id, f.filename, c.chunk_index, c.channel_id, c.message_id, c.size, c.hash, c.doc_id, c.codec, c.stored_size, c.pack_offset "
+                 "FROM chunks c JOIN files f ON f.id = c.file_id")
+        if file_ids:
+            query += f" WHERE f.id IN ({', '.join('?' * len(file_ids))})"
+        rows = self._q(query + " ORDER BY f.id, c.chunk_index", tuple(file_ids or ()), fetch='all')
+        problems = []
+        checked = 0
         
-        for (msg_id,) in chunks:
-            await self.client.delete_messages(self.channel_id, msg_id)
+        def problem(row, what):
+            file_id, filename, idx = row[:3]
+            print(f"⚠️ File {file_id} ({filename}) chunk {idx}: {what}")
+            problems.append((file_id, filename, idx, what))
         
-        self._q("DELETE FROM chunks WHERE file_id = ?", (file_id,))
-        self._q("DELETE FROM files WHERE id = ?", (file_id,))
-        print(f"Deleted file {file_id}")
+        for start in range(0, len(rows), SCRUB_BATCH):
+            if start:
+                await asyncio.sleep(pause)
+            batch = rows[start:start + SCRUB_BATCH]
+            keys = [(channel_id or self.channel_id, msg_id) for _, _, _, channel_id, msg_id, *_ in batch]
+            documents = await self._documents(keys)
+            for key, row in zip(keys, batch):
+                file_id, _, idx, _, _, size, chunk_hash, doc_id, codec, stored_size, pack_offset = row
+                doc, account = documents[key]
+                # A packed file only needs its span to be there; the rest of the pack belongs to other files
+                end = (pack_offset or 0) + (stored_size or size)
+                if doc is None:
+                    problem(row, "message is missing from Telegram")
+                elif doc.size < end or (pack_offset is None and doc.size != end):
+                    problem(row, f"document is {doc.size} bytes, expected {'at least ' if pack_offset is not None else ''}{end}")
+                elif doc_id is not None and doc.id != doc_id:
+                    problem(row, "message holds a different document")
+                elif deep:
+                    ref = ChunkRef(*key, doc.id, doc.access_hash, doc.file_reference, doc.dc_id, account, codec, stored_size, pack_offset)
+                    verifier = ChunkVerifier(chunk_hash, size, name="content")
+                    try:
+                        async for data in self._iter_chunk(ref, size):
+                            verifier.update(data)
+                        verifier.check()
+                    except Exception as e:
+                        problem(row, str(e) or type(e).__name__)
+            checked += len(batch)
+            print(f"Scrubbed {checked}/{len(rows)} chunks, {len(problems)} problem{'' if len(problems) == 1 else 's'}")
+        return {'files': len({row[0] for row in rows}), 'chunks': len(rows), 'bytes': sum(row[5] for row in rows), 'problems': problems}